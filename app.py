@@ -16,158 +16,281 @@
 
 import config
 from .logger import logger, log_update
-from .database import database
+from .database import database, check_server_version
+from .engine import engine, games
 from .game import stop_game, role_titles
 from .stages import go_to_next_stage
+from .scheduler import scheduler
+from .timers import timers
+from .cache import game_cache
+from .stats import StatsBatch, ensure_leaderboards
+from .guess import discard_matcher
+from .indexes import ensure_indexes, report_indexes
 from .bot import bot
+from .workers import workers, KeyedWorkers
+from .recorder import recorder
+from .metrics import registry, scheduler_lag
+from .profiler import profiler
+from .lease import leader_lease
 
+import hmac
 import flask
 from time import time
 from threading import Thread
+from collections import Counter
 from telebot.types import Update
 
 
-def remove_overtimed_requests():
-while True:
-delete_result = database.requests.delete_many({
-  'time': {
-    '$lte': time()}})
-deleted_count = delete_result.deleted_count
-if deleted_count > 0:
-logger.info(f'Удалено просроченных заявок: {
-  deleted_count
-}')
+@timers.on('request')
+def remove_overtimed_requests(request_ids):
+    delete_result = database.requests.delete_many({'_id': {'$in': request_ids}, 'time': {'$lte': time()}})
+    deleted_count = delete_result.deleted_count
+    if deleted_count > 0:
+        logger.info('Удалено просроченных заявок: %s', deleted_count)
 
 
 def is_game_over(game):
-try:
-alive_players = [p for p in game['players'] if p['alive']]
-mafia = sum(p['role'] in ('don', 'mafia') for p in alive_players)
-return 1 if not mafia else 2 if mafia >= len(alive_players) - mafia else 0
-except KeyError:
-return 0
+    try:
+        alive_players = [p for p in game['players'] if p['alive']]
+        mafia = sum(p['role'] in ('don', 'mafia') for p in alive_players)
+        return 1 if not mafia else 2 if mafia >= len(alive_players) - mafia else 0
+    except KeyError:
+        return 0
+
+
+def count_active_games():
+    if engine is not None:
+        counts = Counter(game['game'] for game in games.find({}, {'game': True}))
+        yield from (((name,), count) for name, count in counts.items())
+        return
+    for group in games.aggregate([{'$group': {'_id': '$game', 'count': {'$sum': 1}}}]):
+        yield (group['_id'],), group['count']
+
+
+registry.gauge('mafia_active_games', 'Games in progress by type', ('game',), collect=count_active_games)
 
 
 def stage_cycle():
-while True:
-games_to_modify = database.games.find({
-  'game': 'mafia', 'next_stage_time': {
-    '$lte': time()}})
-for game in games_to_modify:
-game_state = is_game_over(game)
-if game_state:
-role = role_titles['peace' if game_state == 1 else 'mafia']
-for player in game['players']:
-player_role = player['role'] if player['role'] != 'don' else 'mafia'
-inc_dict = {
-  'total': 1, f' {
-    player_role
-  }.total': 1
-}
-if (
-  (game_state == 1 and player_role != 'mafia') or
-  (game_state == 2 and player_role == 'mafia')
-):
-inc_dict['win'] = 1
-inc_dict[f' {
-  player_role
-}.win'] = 1
-database.stats.update_one(
-  {
-    'id': player['id'], 'chat': game['chat']},
-  {
-    '$set': {
-      'name': player['full_name']}, '$inc': inc_dict
-  },
-  upsert = True
-)
-stop_game(game, reason = f'Победили игроки команды " {
-  role
-}"!')
-continue
-
-game = go_to_next_stage(game)
-
-
-def croco_cycle():
-while True:
-curtime = time()
-games = list(database.games.find({
-  'game': 'croco', 'time': {
-    '$lte': curtime
-  }}))
-for game in games:
-if game['stage'] == 0:
-database.games.update_one({
-  '_id': game['_id']}, {
-  '$set': {
-    'stage': 1, 'time': curtime + 60
-  }})
-bot.try_to_send_message(game['chat'], f' {
-  game["name"].capitalize()}, до конца игры осталась минута!')
-else :
-database.games.delete_one({
-  '_id': game['_id']})
-bot.try_to_send_message(game['chat'], f'Игра окончена! {
-  game["name"].capitalize()} проигрывает, загаданное слово было {game["word"]}.')
-database.stats.update_one(
-  {
-    'id': game['player'], 'chat': game['chat']},
-  {
-    '$set': {
-      'name': game['full_name']}, '$inc': {
-      'croco.total': 1
-    }},
-  upsert = True
+    stage_workers.start()
+    while True:
+        term = leader_lease.wait()
+        # Deadlines of a previous term may have been handled by another leader since
+        scheduler.clear()
+        scheduler.load(games.find(
+            {'game': 'mafia', 'next_stage_time': {'$exists': True}},
+            {'next_stage_time': True}
+        ))
+
+        while leader_lease.holds(term):
+            due = scheduler.wait(timeout=leader_lease.heartbeat if leader_lease.enabled else None)
+            if not due or not leader_lease.holds(term):
+                continue
+            for game_id, deadline in due:
+                if not stage_workers.put(game_id):
+                    logger.warning('Очередь смены стадий переполнена, игра %s отложена', game_id)
+                    scheduler.schedule(game_id, time() + stage_retry_delay)
+
+            if scheduler.lateness > 1:
+                logger.warning('Смена стадии опоздала на %.3f с', scheduler.lateness)
+
+
+def handle_due_stage(game_id):
+    try:
+        with profiler.capture():
+            process_due_stage(game_id)
+    except Exception:
+        logger.exception('Ошибка при смене стадии игры %s', game_id)
+        scheduler.schedule(game_id, time() + stage_retry_delay)
+
+
+def process_due_stage(game_id):
+    game = games.find_one({'_id': game_id, 'game': 'mafia'})
+    if game is None:
+        return
+    if game['next_stage_time'] > time():
+        scheduler.schedule(game['_id'], game['next_stage_time'])
+        return
+    scheduler_lag.observe(time() - game['next_stage_time'])
+
+    game_state = is_game_over(game)
+    if game_state:
+        role = role_titles['peace' if game_state == 1 else 'mafia']
+        stats = StatsBatch()
+        for player in game['players']:
+            player_role = player['role'] if player['role'] != 'don' else 'mafia'
+            inc_dict = {'total': 1, f'{player_role}.total': 1}
+            if (
+                (game_state == 1 and player_role != 'mafia') or
+                (game_state == 2 and player_role == 'mafia')
+            ):
+                inc_dict['win'] = 1
+                inc_dict[f'{player_role}.win'] = 1
+            stats.add(game['chat'], player['id'], inc_dict, name=player['full_name'])
+        if stop_game(game, reason=f'Победили игроки команды "{role}"!'):
+            stats.commit()
+        return
+
+    go_to_next_stage(game)
+
+
+# Stage functions wait for the Telegram rate limits of their chat, so each
+# game is pinned to a worker and a throttled chat only delays its own worker.
+# A chat has at most one mafia game, so game ids partition them like chats.
+stage_retry_delay = getattr(config, 'STAGE_RETRY_DELAY', 5)
+stage_workers = KeyedWorkers(
+    'Stage Worker',
+    handle_due_stage,
+    key=lambda game_id: game_id,
+    count=getattr(config, 'STAGE_WORKERS_COUNT', 8),
+    queue_size=getattr(config, 'STAGE_QUEUE_SIZE', 1000)
 )
 
 
-def start_thread(name = None, target = None, *args, daemon = True, **kwargs):
-thread = Thread(*args, name = name, target = target, daemon = daemon, **kwargs)
-logger.debug(f'Запускаю процесс < {
-  thread.name
-}>')
-thread.start()
+@timers.on('croco')
+def croco_cycle(game_ids):
+    curtime = time()
+    expired = list(games.find({'_id': {'$in': game_ids}, 'game': 'croco', 'time': {'$lte': curtime}}))
+
+    warned = [game for game in expired if game['stage'] == 0]
+    if warned:
+        games.update_many(
+            {'_id': {'$in': [game['_id'] for game in warned]}, 'stage': 0},
+            {'$set': {'stage': 1, 'time': curtime + 60}}
+        )
+        for game in warned:
+            timers.add('croco', game['_id'], curtime + 60)
+            game_cache.invalidate(game['chat'])
+            bot.try_to_send_message(game['chat'], f'{game["name"].capitalize()}, до конца игры осталась минута!')
+
+    finished = [game for game in expired if game['stage'] != 0]
+    if finished:
+        games.delete_many({'_id': {'$in': [game['_id'] for game in finished]}})
+        stats = StatsBatch()
+        for game in finished:
+            game_cache.invalidate(game['chat'])
+            discard_matcher(game)
+            bot.try_to_send_message(
+                game['chat'],
+                f'Игра окончена! {game["name"].capitalize()} проигрывает, загаданное слово было {game["word"]}.'
+            )
+            stats.add(game['chat'], game['player'], {'croco.total': 1}, name=game['full_name'])
+        stats.commit()
+
+
+@timers.on('resync')
+def resync_timers(keys):
+    """Pick up deadlines set by handlers of other instances, which reach the leader only through the database."""
+    try:
+        horizon = time() + 2 * leader_lease.resync_interval
+        scheduler.load(games.find(
+            {'game': 'mafia', 'next_stage_time': {'$lte': horizon}},
+            {'next_stage_time': True}
+        ))
+        for request in database.requests.find({'time': {'$lte': horizon}}, {'time': True}):
+            timers.add('request', request['_id'], request['time'])
+        for game in games.find({'game': 'croco', 'time': {'$lte': horizon}}, {'time': True}):
+            timers.add('croco', game['_id'], game['time'])
+    finally:
+        timers.add('resync', None, time() + leader_lease.resync_interval)
+
+
+index_report_interval = getattr(config, 'INDEX_REPORT_INTERVAL', 24 * 60 * 60)
+
+
+@timers.on('indexes')
+def report_unused_indexes(keys):
+    """Report indexes once they have had time to be used, rather than right after they are created."""
+    try:
+        report_indexes()
+    finally:
+        timers.add('indexes', None, time() + index_report_interval)
+
+
+def timer_cycle():
+    while True:
+        term = leader_lease.wait()
+        timers.clear()
+        for request in database.requests.find({}, {'time': True}):
+            timers.add('request', request['_id'], request['time'])
+        for game in games.find({'game': 'croco'}, {'time': True}):
+            timers.add('croco', game['_id'], game['time'])
+        if leader_lease.enabled:
+            timers.add('resync', None, time() + leader_lease.resync_interval)
+        timers.add('indexes', None, time() + index_report_interval)
+
+        timers.run(active=lambda: leader_lease.holds(term))
+
+
+def start_thread(name=None, target=None, *args, daemon=True, **kwargs):
+    thread = Thread(*args, name=name, target=target, daemon=daemon, **kwargs)
+    logger.debug('Запускаю процесс <%s>', thread.name)
+    thread.start()
+
+
+def create_app():
+    app = flask.Flask(__name__)
+
+    @app.route('/' + config.TOKEN, methods=['POST'])
+    def webhook():
+        if flask.request.headers.get('content-type') == 'application/json':
+            arrival = time()
+            json_string = flask.request.get_data().decode('utf-8')
+            if recorder is not None:
+                recorder.record(json_string, arrival)
+            update = Update.de_json(json_string)
+            log_update(update)
+            if not workers.put(update):
+                logger.warning('Очередь обновлений переполнена, обновление %s отклонено', update.update_id)
+                flask.abort(503)
+            return ''
+        else:
+            flask.abort(403)
+
+    # The webhook port is public, so metrics are only served to scrapers presenting METRICS_TOKEN
+    metrics_token = getattr(config, 'METRICS_TOKEN', None)
+    if metrics_token:
+        @app.route('/metrics', methods=['GET'])
+        def metrics():
+            authorization = flask.request.headers.get('authorization', '')
+            if not hmac.compare_digest(authorization.encode(), f'Bearer {metrics_token}'.encode()):
+                flask.abort(403)
+            return flask.Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
 
 
 def run_app():
-app = flask.Flask(__name__)
-
-@app.route('/' + config.TOKEN, methods = ['POST'])
-def webhook():
-if flask.request.headers.get('content-type') == 'application/json':
-json_string = flask.request.get_data().decode('utf-8')
-update = Update.de_json(json_string)
-log_update(update)
-bot.process_new_updates([update])
-return ''
-else :
-flask.abort(403)
-
-app.run(
-  host = config.SERVER_IP,
-  port = config.SERVER_PORT,
-  ssl_context = (config.SSL_CERT, config.SSL_PRIV),
-  debug = False
-)
+    app = create_app()
+    app.run(
+        host=config.SERVER_IP,
+        port=config.SERVER_PORT,
+        ssl_context=(config.SSL_CERT, config.SSL_PRIV),
+        debug=False
+    )
 
 
 def main():
-start_thread('Stage Cycle', stage_cycle)
-start_thread('Removing Requests', remove_overtimed_requests)
-start_thread('Crocodile Cycle', croco_cycle)
-
-if config.SET_WEBHOOK:
-url = f'https:// {
-  config.SERVER_IP
-}: {
-  config.SERVER_PORT
-}/'
-logger.debug(f'Запускаю приложение по адресу {
-  url
-}')
-run_app()
-bot.remove_webhook()
-bot.set_webhook(url = url + config.TOKEN)
-else :
-bot.polling()
\ No newline at end of file
+    if engine is None:
+        check_server_version()
+    ensure_indexes()
+    ensure_leaderboards()
+    bot.refresh_identity()
+    logger.debug('Работаю от имени @%s', bot.identity.username)
+
+    if engine is not None:
+        engine.recover()
+        start_thread('Game Journal', engine.run)
+    if leader_lease.enabled:
+        start_thread('Leader Lease', leader_lease.run)
+    start_thread('Stage Cycle', stage_cycle)
+    start_thread('Timers', timer_cycle)
+
+    if config.SET_WEBHOOK:
+        url = f'https://{config.SERVER_IP}:{config.SERVER_PORT}/'
+        logger.debug('Запускаю приложение по адресу %s', url)
+        workers.start()
+        run_app()
+        bot.remove_webhook()
+        bot.set_webhook(url=url + config.TOKEN)
+    else:
+        bot.polling()
@@ -0,0 +1,201 @@
+"""Microbenchmarks of the CPU-bound hot paths.
+
+Runs offline: config is replaced by a stub, Mongo by a mock client and every
+Telegram call by a no-op, so only the Python code of the bot is measured.
+
+    python benchmarks/hot_paths.py --output results.json
+    python benchmarks/hot_paths.py --compare results.json
+"""
+
+import os
+import sys
+import json
+import types
+import random
+import tempfile
+import platform
+import argparse
+import importlib
+import statistics
+from time import time
+from timeit import Timer
+from unittest import mock
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLAYERS_COUNT_LIMIT = 20
+WORDS_COUNT = 100000
+
+
+def make_word_base(path, count):
+    letters = 'абвгдежзийклмнопрстуфхцчшщъыьэюя'
+    with open(path, 'wb') as base:
+        for _ in range(count):
+            word = ''.join(random.choice(letters) for _ in range(random.randint(3, 14)))
+            base.write((word + '\r\n').encode('cp1251'))
+
+
+def load_package(word_base):
+    config = types.ModuleType('config')
+    config.TOKEN = '0:benchmark'
+    config.SKIP_PENDING = False
+    config.SET_WEBHOOK = True
+    config.LOGGER_LEVEL = 'ERROR'
+    config.WORD_BASE = word_base
+    config.DELETE_FROM_EVERYONE = False
+    config.PLAYERS_COUNT_LIMIT = PLAYERS_COUNT_LIMIT
+    config.PLAYERS_COUNT_TO_START = 4
+    config.REQUEST_OVERDUE_TIME = 600
+    config.ADMIN_ID = 0
+    sys.modules['config'] = config
+
+    sys.path.insert(0, os.path.dirname(ROOT))
+    with mock.patch('pymongo.MongoClient', mock.MagicMock()):
+        return importlib.import_module(os.path.basename(ROOT))
+
+
+def make_mafia_game(players_count):
+    cards = ['mafia'] * (players_count // 3 - 1) + ['don', 'sheriff']
+    cards += ['peace'] * (players_count - len(cards))
+    random.shuffle(cards)
+    players = [
+        {'id': 1000 + i, 'name': f'@player{i}', 'full_name': f'Player {i}', 'role': role, 'alive': i % 4 != 0}
+        for i, role in enumerate(cards)
+    ]
+    vote = {}
+    for i, player in enumerate(players):
+        if player['alive']:
+            vote.setdefault(str(random.randrange(-1, players_count)), []).append(i)
+    return {'_id': 1, 'game': 'mafia', 'chat': -1, 'stage': 1, 'players': players, 'vote': vote}
+
+
+def make_gallows_game(players_count, word):
+    names = {str(1000 + i): f'@player{i}' for i in range(players_count)}
+    letters = list(dict.fromkeys(word))
+    right = {ch: 1000 + i % players_count for i, ch in enumerate(letters[:len(letters) // 2])}
+    wrong = {ch: 1000 + i % players_count for i, ch in enumerate('ъыьэю')}
+    return {
+        '_id': 2, 'game': 'gallows', 'chat': -1, 'word': word, 'message_id': 1,
+        'names': names, 'right': right, 'wrong': wrong
+    }
+
+
+def collect(package):
+    app = package.app
+    stages = package.stages
+    handlers = package.handlers
+    gallows = package.gallows
+    croco = package.croco
+    guess = package.guess
+    stats = package.stats
+
+    benchmarks = []
+
+    def add(name, params, func):
+        benchmarks.append((name, params, func))
+
+    for players_count in (4, 10, PLAYERS_COUNT_LIMIT):
+        game = make_mafia_game(players_count)
+        params = {'players': players_count}
+        add('app.is_game_over', params, lambda game=game: app.is_game_over(game))
+        add('stages.format_roles', params, lambda game=game: stages.format_roles(game))
+        add('stages.format_roles[show_roles]', params, lambda game=game: stages.format_roles(game, True))
+        add('stages.get_votes', params, lambda game=game: stages.get_votes(game))
+
+        word = croco.get_word()
+        gallows_game = make_gallows_game(players_count, word)
+        add('gallows.get_stats', params, lambda game=gallows_game: gallows.get_stats(game))
+        add('gallows.set_gallows', params, lambda game=gallows_game: gallows.set_gallows(game, '', ' '.join(word)))
+
+    rating = [(f'@player{i}', random.randint(-50, 50)) for i in range(5)]
+    add('handlers.get_rating_list', {'entries': 5}, lambda: handlers.get_rating_list(rating))
+
+    increments = {'total': 1, 'win': 1, 'mafia.total': 1, 'mafia.win': 1}
+    add('stats.get_score_increments', {}, lambda: stats.get_score_increments(increments))
+
+    add('croco.get_word', {'words': len(croco.word_base)}, croco.get_word)
+
+    word = croco.get_word()
+    matcher = guess.GuessMatcher(word)
+    miss = 'мне кажется это что-то круглое и зелёное, может быть арбуз?'
+    hit = f'это же {word}!'
+    add('guess.GuessMatcher', {}, lambda: guess.GuessMatcher(word))
+    add('guess.GuessMatcher.matches[miss]', {}, lambda: matcher.matches(miss))
+    add('guess.GuessMatcher.matches[hit]', {}, lambda: matcher.matches(hit))
+
+    return benchmarks
+
+
+def measure(func, repeat, min_time):
+    timer = Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    timings = [timer.timeit(number) / number * 1e9 for _ in range(repeat)]
+    return {
+        'number': number,
+        'best_ns': min(timings),
+        'mean_ns': statistics.mean(timings),
+        'stdev_ns': statistics.stdev(timings) if len(timings) > 1 else 0
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in json.load(baseline_file)['results']}
+    for result in results:
+        old = baseline.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if old is not None:
+            result['baseline_best_ns'] = old['best_ns']
+            result['ratio'] = result['best_ns'] / old['best_ns']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='file to write the JSON results to (stdout by default)')
+    parser.add_argument('--compare', help='previous JSON results to compare with')
+    parser.add_argument('--filter', default='', help='run only benchmarks whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.05, help='minimal duration of one repeat in seconds')
+    parser.add_argument('--words', type=int, default=WORDS_COUNT, help='size of the generated word base')
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        word_base = os.path.join(directory, 'words.txt')
+        make_word_base(word_base, args.words)
+        package = load_package(word_base)
+
+        with mock.patch.object(package.bot.bot, 'edit_message_text'):
+            results = []
+            for name, params, func in collect(package):
+                if args.filter in name:
+                    results.append({'name': name, 'params': params, **measure(func, args.repeat, args.min_time)})
+
+    if args.compare:
+        compare(results, args.compare)
+
+    report = {
+        'meta': {
+            'timestamp': time(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine()
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, ensure_ascii=False)
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        sys.stdout.write('\n')
+
+    for result in results:
+        ratio = f'  x{result["ratio"]:.2f}' if 'ratio' in result else ''
+        params = ', '.join(f'{k}={v}' for k, v in result['params'].items())
+        print(f'{result["name"]:<40} {params:<16} {result["best_ns"]:>12.0f} ns{ratio}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,61 +1,187 @@
 import config
 from .logger import logger
-from .database import database
+from .cache import game_cache
+from .view import find_game, GAME_HEADER
+from .sender import sender, ANSWER, SEND, EDIT
+from .metrics import handled_updates, handler_latency
+from .profiler import profiler
 
+from functools import wraps
 from telebot import TeleBot
-from telebot.apihelper import ApiException
 
 
 def group_only(message):
-return message.chat.type in ('group', 'supergroup')
+    return message.chat.type in ('group', 'supergroup')
 
 
 class MafiaHostBot(TeleBot):
-def try_to_send_message(self, *args, **kwargs):
-try:
-self.send_message(*args, **kwargs)
-except ApiException:
-logger.error('Ошибка API при отправке сообщения', exc_info=True)
-
-def _game_handler(self, handler):
-def decorator(message, *args, **kwargs):
-game = database.games.find_one({'chat': message.chat.id})
-if game and game['game'] == 'mafia':
-try:
-player = next(p for p in game['players'] if p['id'] == message.from_user.id)
-except StopIteration:
-delete = config.DELETE_FROM_EVERYONE and game['stage'] not in (0, -4)
-else:
-if game['stage'] in (2, 7):
-victim = game.get('victim')
-delete = not player.get('alive', True) if victim is None else victim != message.from_user.id
-else:
-delete = not player.get('alive', True) or game['stage'] not in (0, -4)
-if delete:
-self.safely_delete_message(chat_id=message.chat.id, message_id=message.message_id)
-return
-
-return handler(message, game, *args, **kwargs)
-return decorator
-
-def group_message_handler(self, *, func=None, **kwargs):
-def decorator(handler):
-if func is None:
-conjuction = group_only
-else:
-conjuction = lambda message: group_only(message) and func(message)
-
-new_handler = self._game_handler(handler)
-handler_dict = self._build_handler_dict(new_handler, func=conjuction, **kwargs)
-self.add_message_handler(handler_dict)
-return new_handler
-return decorator
-
-def safely_delete_message(self, *args, **kwargs):
-try:
-self.delete_message(*args, **kwargs)
-except ApiException:
-logger.debug('Ошибка API при удалении сообщения', exc_info=True)
-
-
-bot = MafiaHostBot(config.TOKEN, skip_pending=config.SKIP_PENDING)
\ No newline at end of file
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._commands = {}
+        self._callbacks = {}
+        self._identity = None
+        self.message_handler(func=self._find_command)(self._route_command)
+        self.callback_query_handler(func=self._find_callback)(self._route_callback)
+
+    @property
+    def identity(self):
+        if self._identity is None:
+            self.refresh_identity()
+        return self._identity
+
+    def refresh_identity(self):
+        self._identity = self.get_me()
+        return self._identity
+
+    def set_identity(self, user):
+        self._identity = user
+
+    def _find_command(self, message):
+        """Filter of the command router, keeping the handler it found on the message for `_route_command`."""
+        message.routed_handler = self._match_command(message)
+        return message.routed_handler
+
+    def _match_command(self, message):
+        text = message.text
+        # The filter runs before telebot checks content types, so it also sees stickers and service messages
+        if not text or not text.startswith('/') or len(text) == 1 or text[1].isspace():
+            return None
+        command, _, username = text[1:].split(maxsplit=1)[0].lower().partition('@')
+        if username and username != self.identity.username.lower():
+            return None
+        for func, handler in self._commands.get(command, ()):
+            if func(message):
+                return handler
+        return None
+
+    def process_new_updates(self, updates):
+        with profiler.capture():
+            super().process_new_updates(updates)
+
+    @staticmethod
+    def _measure(update_type, handler, update):
+        handled_updates.inc(update_type, handler.__name__)
+        with handler_latency.time(update_type, handler.__name__), profiler.capture():
+            return handler(update)
+
+    def _route_command(self, message):
+        return self._measure('message', message.routed_handler, message)
+
+    def _find_callback(self, call):
+        """Filter of the callback router, keeping the handler it found on the call for `_route_callback`."""
+        handler = None
+        if call.data is not None:
+            handler = self._callbacks.get(call.data)
+            if handler is None:
+                handler = self._callbacks.get(call.data.rsplit(' ', 1)[0])
+        call.routed_handler = handler
+        return handler
+
+    def _route_callback(self, call):
+        return self._measure('callback_query', call.routed_handler, call)
+
+    def command_handler(self, *commands, func=None):
+        def decorator(handler):
+            for command in commands:
+                self._commands.setdefault(command, []).append((func or (lambda message: True), handler))
+            return handler
+        return decorator
+
+    def group_command_handler(self, *commands, func=None):
+        def decorator(handler):
+            if func is None:
+                conjuction = group_only
+            else:
+                conjuction = lambda message: group_only(message) and func(message)
+
+            new_handler = self._game_handler(handler)
+            self.command_handler(*commands, func=conjuction)(new_handler)
+            return new_handler
+        return decorator
+
+    def callback_handler(self, *names):
+        def decorator(handler):
+            for name in names:
+                self._callbacks[name] = handler
+            return handler
+        return decorator
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return sender.submit(SEND, chat_id, super().send_message, chat_id, *args, **kwargs).result()
+
+    def edit_message_text(self, *args, chat_id=None, **kwargs):
+        return sender.submit(EDIT, chat_id, super().edit_message_text, *args, chat_id=chat_id, **kwargs).result()
+
+    def coalesce_edit_message_text(self, text, chat_id, message_id, **kwargs):
+        def log_error(future):
+            if future.exception() is not None:
+                logger.debug('Ошибка API при изменении сообщения', exc_info=future.exception())
+
+        sender.coalesce(
+            (chat_id, message_id), chat_id, super().edit_message_text,
+            text, chat_id=chat_id, message_id=message_id, **kwargs
+        ).add_done_callback(log_error)
+
+    def edit_message_reply_markup(self, *args, chat_id=None, **kwargs):
+        return sender.submit(EDIT, chat_id, super().edit_message_reply_markup, *args, chat_id=chat_id, **kwargs).result()
+
+    def delete_message(self, chat_id, *args, **kwargs):
+        return sender.submit(EDIT, chat_id, super().delete_message, chat_id, *args, **kwargs).result()
+
+    def answer_callback_query(self, *args, **kwargs):
+        return sender.submit(ANSWER, None, super().answer_callback_query, *args, **kwargs).result()
+
+    def try_to_send_message(self, chat_id, *args, **kwargs):
+        def log_error(future):
+            if future.exception() is not None:
+                logger.error('Ошибка API при отправке сообщения', exc_info=future.exception())
+
+        sender.submit(SEND, chat_id, super().send_message, chat_id, *args, **kwargs).add_done_callback(log_error)
+
+    def _game_handler(self, handler):
+        @wraps(handler)
+        def decorator(message, *args, **kwargs):
+            game = game_cache.get(message.chat.id, lambda: find_game({'chat': message.chat.id}, GAME_HEADER))
+            if game and game['game'] == 'mafia':
+                try:
+                    player = next(p for p in game['players'] if p['id'] == message.from_user.id)
+                except StopIteration:
+                    delete = config.DELETE_FROM_EVERYONE and game['stage'] not in (0, -4)
+                else:
+                    if game['stage'] in (2, 7):
+                        victim = game.get('victim')
+                        delete = not player.get('alive', True) if victim is None else victim != message.from_user.id
+                    else:
+                        delete = not player.get('alive', True) or game['stage'] not in (0, -4)
+                if delete:
+                    self.safely_delete_message(chat_id=message.chat.id, message_id=message.message_id)
+                    return
+
+            return handler(message, game, *args, **kwargs)
+        return decorator
+
+    def group_message_handler(self, *, func=None, **kwargs):
+        def decorator(handler):
+            if func is None:
+                conjuction = group_only
+            else:
+                conjuction = lambda message: group_only(message) and func(message)
+
+            new_handler = self._game_handler(handler)
+            handler_dict = self._build_handler_dict(
+                lambda message: self._measure('message', new_handler, message), func=conjuction, **kwargs
+            )
+            self.add_message_handler(handler_dict)
+            return new_handler
+        return decorator
+
+    def safely_delete_message(self, chat_id, *args, **kwargs):
+        def log_error(future):
+            if future.exception() is not None:
+                logger.debug('Ошибка API при удалении сообщения', exc_info=future.exception())
+
+        sender.submit(EDIT, chat_id, super().delete_message, chat_id, *args, **kwargs).add_done_callback(log_error)
+
+
+# With a webhook, updates are handled by the per-chat workers instead of telebot's thread pool
+bot = MafiaHostBot(config.TOKEN, skip_pending=config.SKIP_PENDING, threaded=not config.SET_WEBHOOK)
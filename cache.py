@@ -0,0 +1,58 @@
+import config
+
+from copy import deepcopy
+from time import time
+from threading import Lock
+from collections import OrderedDict
+
+
+class GameCache:
+    """Chat to game mapping with write-through invalidation.
+
+    Chats without a game are cached as well, so that regular chatter does not
+    reach the database. Every write to a game document must be followed by
+    `invalidate` for its chat.
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = Lock()
+
+    def get(self, chat, loader):
+        with self._lock:
+            entry = self._entries.get(chat)
+            if entry is not None and entry[0] > time():
+                self._entries.move_to_end(chat)
+                return deepcopy(entry[1])
+            generation = (self._epoch, self._generations.get(chat, 0))
+
+        game = loader()
+
+        with self._lock:
+            if (self._epoch, self._generations.get(chat, 0)) == generation:
+                self._entries[chat] = (time() + self.ttl, game)
+                self._entries.move_to_end(chat)
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return deepcopy(game)
+
+    def invalidate(self, chat):
+        with self._lock:
+            self._entries.pop(chat, None)
+            self._generations[chat] = self._generations.get(chat, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+
+# Other instances cannot invalidate this cache, so with several of them entries only live for a second
+game_cache = GameCache(
+    ttl=getattr(config, 'GAME_CACHE_TTL', 1 if getattr(config, 'LEADER_LEASE', False) else 60),
+    max_size=getattr(config, 'GAME_CACHE_SIZE', 100000)
+)
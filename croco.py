@@ -16,57 +16,65 @@
 
 import config
 from .bot import bot
-from .database import database
+from .engine import games
+from .cache import game_cache
+from .stats import StatsBatch
+from .guess import get_matcher, discard_matcher
 
-import re
-import codecs
+import mmap
 import random
-from os.path import getsize
+from array import array
 
 
-BASE_SIZE = getsize(config.WORD_BASE)
+class WordBase:
+    """Memory-mapped word file with an index of line offsets for uniform sampling."""
+
+    def __init__(self, path, encoding='cp1251'):
+        self.encoding = encoding
+        with open(path, 'rb') as base:
+            self._map = mmap.mmap(base.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offsets = array('I')
+        position = 0
+        size = len(self._map)
+        while position < size:
+            end = self._map.find(b'\n', position)
+            if end == -1:
+                end = size
+            if self._map[position:end].strip():
+                self._offsets.append(position)
+            position = end + 1
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def get_word(self):
+        start = self._offsets[random.randrange(len(self._offsets))]
+        end = self._map.find(b'\n', start)
+        return self._map[start:end if end != -1 else len(self._map)].decode(self.encoding).strip()
+
+
+word_base = WordBase(config.WORD_BASE)
 
 
 def get_word():
-with codecs.open(config.WORD_BASE, 'r', encoding = 'cp1251') as base:
-offset = random.randrange(BASE_SIZE)
-base.seek(offset)
-base.readline()
-word = base.readline()
-return word
+    return word_base.get_word()
 
 
 def croco_suggestion(suggestion, game, user, message_id):
-if not re.search(r'\b{}\b'.format(game['word']), suggestion):
-return
-increments = {
-  'croco.total': 1
-}
-if user['id'] == game['player']:
-increments['croco.cheat'] = 1
-answer = 'Игра окончена! Нельзя самому называть слово!'
-else :
-increments['croco.win'] = 1
-database.stats.update_one(
-  {
-    'id': user['id'], 'chat': game['chat']},
-  {
-    '$set': {
-      'name': user['full_name']}, '$inc': {
-      'croco.guesses': 1
-    }},
-  upsert = True
-)
-answer = 'Игра окончена! Это верное слово!'
-bot.send_message(game['chat'], answer, reply_to_message_id = message_id)
-database.games.delete_one({
-  '_id': game['_id']})
-database.stats.update_one(
-  {
-    'id': game['player'], 'chat': game['chat']},
-  {
-    '$set': {
-      'name': game['full_name']}, '$inc': increments
-  },
-  upsert = True
-)
\ No newline at end of file
+    if not get_matcher(game).matches(suggestion):
+        return
+    stats = StatsBatch()
+    increments = {'croco.total': 1}
+    if user['id'] == game['player']:
+        increments['croco.cheat'] = 1
+        answer = 'Игра окончена! Нельзя самому называть слово!'
+    else:
+        increments['croco.win'] = 1
+        stats.add(game['chat'], user['id'], {'croco.guesses': 1}, name=user['full_name'])
+        answer = 'Игра окончена! Это верное слово!'
+    bot.send_message(game['chat'], answer, reply_to_message_id=message_id)
+    games.delete_one({'_id': game['_id']})
+    game_cache.invalidate(game['chat'])
+    discard_matcher(game)
+    stats.add(game['chat'], game['player'], increments, name=game['full_name'])
+    stats.commit()
@@ -14,23 +14,149 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import config
+from .logger import logger
+from .metrics import registry, mongo_operations, mongo_latency
+
+from time import perf_counter
+from threading import Lock, local
 from pymongo import MongoClient, ReturnDocument
+from pymongo.monitoring import CommandListener, ConnectionPoolListener, ConnectionCheckOutFailedReason
+
+
+class PoolMonitor(ConnectionPoolListener):
+    """Connection pool listener measuring checkout wait times and pool exhaustion."""
+
+    def __init__(self, slow_checkout):
+        self.slow_checkout = slow_checkout
+        self.open_connections = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.exhausted = 0
+        self._started = local()
+        self._lock = Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'open_connections': self.open_connections,
+                'checked_out': self.checked_out,
+                'checkouts': self.checkouts,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'exhausted': self.exhausted
+            }
+
+    def connection_check_out_started(self, event):
+        self._started.time = perf_counter()
+
+    def connection_checked_out(self, event):
+        wait = perf_counter() - getattr(self._started, 'time', perf_counter())
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        if wait > self.slow_checkout:
+            logger.warning('Ожидание соединения с базой данных заняло %.3f с', wait)
+
+    def connection_check_out_failed(self, event):
+        if event.reason == ConnectionCheckOutFailedReason.TIMEOUT:
+            with self._lock:
+                self.exhausted += 1
+            logger.error('Пул соединений с базой данных %s исчерпан', event.address)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
 
-client = MongoClient()
+
+class CommandMonitor(CommandListener):
+    """Command listener counting MongoDB operations and their duration per collection."""
+
+    def __init__(self):
+        self._collections = {}
+        self._lock = Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get('collection', '')
+        with self._lock:
+            self._collections[event.connection_id, event.request_id] = collection
+
+    def succeeded(self, event):
+        self._finish(event, 'success')
+
+    def failed(self, event):
+        self._finish(event, 'failure')
+
+    def _finish(self, event, outcome):
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), '')
+        mongo_operations.inc(event.command_name, collection, outcome)
+        mongo_latency.observe(event.duration_micros / 1e6, event.command_name, collection)
+
+
+pool_monitor = PoolMonitor(slow_checkout=getattr(config, 'MONGO_SLOW_CHECKOUT', 0.1))
+registry.gauge(
+    'mafia_mongo_pool', 'MongoDB connection pool state, wait times in seconds', ('stat',),
+    collect=lambda: (((stat,), value) for stat, value in pool_monitor.snapshot().items())
+)
+
+# Without MONGO_WRITE_CONCERN the default write concern of the server applies
+options = {'w': config.MONGO_WRITE_CONCERN} if hasattr(config, 'MONGO_WRITE_CONCERN') else {}
+client = MongoClient(
+    getattr(config, 'MONGO_URI', None),
+    maxPoolSize=getattr(config, 'MONGO_MAX_POOL_SIZE', 100),
+    waitQueueTimeoutMS=getattr(config, 'MONGO_WAIT_QUEUE_TIMEOUT_MS', None),
+    serverSelectionTimeoutMS=getattr(config, 'MONGO_SERVER_SELECTION_TIMEOUT_MS', 30000),
+    event_listeners=[pool_monitor, CommandMonitor()],
+    **options
+)
 database = client.mafia_host_bot
 
+# Drawing cards and voting use updates with an aggregation pipeline
+MIN_SERVER_VERSION = (4, 2)
+
+
+def check_server_version():
+    version = tuple(client.server_info()['versionArray'][:2])
+    if version < MIN_SERVER_VERSION:
+        raise RuntimeError(
+            'MongoDB %s or later is required, the server runs %s' %
+            ('.'.join(map(str, MIN_SERVER_VERSION)), '.'.join(map(str, version)))
+        )
+
 
 def get_new_id(collection):
-counter = database.counter.find_one_and_update(
-  {
-    "_id": collection
-  },
-  {
-    "$inc": {
-      "next": 1
-    }},
-  return_document = ReturnDocument.AFTER,
-  upsert = True
-)
+    counter = database.counter.find_one_and_update(
+        {"_id": collection},
+        {"$inc": {"next": 1}},
+        return_document=ReturnDocument.AFTER,
+        upsert=True
+    )
 
-return counter["next"]
\ No newline at end of file
+    return counter["next"]
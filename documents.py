@@ -0,0 +1,345 @@
+"""Evaluation of the MongoDB query, update and projection documents used on games.
+
+Covers the subset the handlers use, so that games can be kept in process
+memory with the same calls as on the collection.
+"""
+
+from copy import deepcopy
+
+
+class _Missing:
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+def _resolve(value, parts):
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        return _resolve(value[parts[0]], parts[1:]) if parts[0] in value else [MISSING]
+    if isinstance(value, list):
+        if parts[0].lstrip('-').isdigit():
+            index = int(parts[0])
+            return _resolve(value[index], parts[1:]) if 0 <= index < len(value) else [MISSING]
+        values = [v for item in value if isinstance(item, dict) for v in _resolve(item, parts) if v is not MISSING]
+        return values or [MISSING]
+    return [MISSING]
+
+
+def _candidates(values):
+    for value in values:
+        yield value
+        if isinstance(value, list):
+            yield from value
+
+
+def _equals(value, expected):
+    if expected is None:
+        return value is None or value is MISSING
+    return value is not MISSING and value == expected
+
+
+def _compare(values, predicate):
+    for value in _candidates(values):
+        if value is MISSING or value is None:
+            continue
+        try:
+            if predicate(value):
+                return True
+        except TypeError:
+            pass
+    return False
+
+
+def _match_operator(operator, argument, values):
+    if operator == '$eq':
+        return any(_equals(value, argument) for value in _candidates(values))
+    if operator == '$ne':
+        return not any(_equals(value, argument) for value in _candidates(values))
+    if operator == '$in':
+        return any(_equals(value, option) for value in _candidates(values) for option in argument)
+    if operator == '$nin':
+        return not any(_equals(value, option) for value in _candidates(values) for option in argument)
+    if operator == '$exists':
+        return any(value is not MISSING for value in values) == bool(argument)
+    if operator == '$lt':
+        return _compare(values, lambda value: value < argument)
+    if operator == '$lte':
+        return _compare(values, lambda value: value <= argument)
+    if operator == '$gt':
+        return _compare(values, lambda value: value > argument)
+    if operator == '$gte':
+        return _compare(values, lambda value: value >= argument)
+    if operator == '$elemMatch':
+        return any(
+            isinstance(item, dict) and matches(item, argument)
+            for value in values if isinstance(value, list) for item in value
+        )
+    raise NotImplementedError(f'query operator {operator} is not supported')
+
+
+def _is_operator_document(condition):
+    return isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(document, part) for part in condition):
+                return False
+        else:
+            values = _resolve(document, key.split('.'))
+            if _is_operator_document(condition):
+                if not all(_match_operator(op, argument, values) for op, argument in condition.items()):
+                    return False
+            elif not any(_equals(value, condition) for value in _candidates(values)):
+                return False
+    return True
+
+
+def _parent(document, parts, create):
+    node = document
+    for part in parts[:-1]:
+        if isinstance(node, list):
+            node = node[int(part)]
+        elif part in node or create:
+            node = node.setdefault(part, {})
+        else:
+            return None
+    return node
+
+
+def _set(document, path, value):
+    parts = path.split('.')
+    node = _parent(document, parts, create=True)
+    if isinstance(node, list):
+        node[int(parts[-1])] = value
+    else:
+        node[parts[-1]] = value
+
+
+def _get(document, path, default=MISSING):
+    parts = path.split('.')
+    node = _parent(document, parts, create=False)
+    if node is None:
+        return default
+    if isinstance(node, list):
+        index = int(parts[-1])
+        return node[index] if 0 <= index < len(node) else default
+    return node.get(parts[-1], default)
+
+
+def _unset(document, path):
+    parts = path.split('.')
+    node = _parent(document, parts, create=False)
+    if isinstance(node, list):
+        node[int(parts[-1])] = None
+    elif node is not None:
+        node.pop(parts[-1], None)
+
+
+def _each(value):
+    return value['$each'] if isinstance(value, dict) and '$each' in value else [value]
+
+
+def _apply_operators(document, update):
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            value = deepcopy(value)
+            if operator == '$set':
+                _set(document, path, value)
+            elif operator == '$unset':
+                _unset(document, path)
+            elif operator == '$inc':
+                _set(document, path, _get(document, path, 0) + value)
+            elif operator == '$push':
+                array = _get(document, path, None)
+                if array is None:
+                    array = []
+                    _set(document, path, array)
+                array.extend(_each(value))
+            elif operator == '$addToSet':
+                array = _get(document, path, None)
+                if array is None:
+                    array = []
+                    _set(document, path, array)
+                array.extend(item for item in _each(value) if item not in array)
+            elif operator == '$pull':
+                array = _get(document, path, None)
+                if array is not None:
+                    array[:] = [
+                        item for item in array
+                        if not (matches(item, value) if isinstance(value, dict) and isinstance(item, dict) else item == value)
+                    ]
+            else:
+                raise NotImplementedError(f'update operator {operator} is not supported')
+
+
+def _field_path(value, path):
+    for part in path.split('.'):
+        if isinstance(value, list):
+            value = [item[part] for item in value if isinstance(item, dict) and part in item]
+        elif isinstance(value, dict) and part in value:
+            value = value[part]
+        else:
+            return None
+    return value
+
+
+def evaluate(expression, document, variables=None):
+    """Value of an aggregation expression for `document`."""
+    variables = variables or {}
+    if isinstance(expression, str) and expression.startswith('$$'):
+        name, _, path = expression[2:].partition('.')
+        value = document if name == 'ROOT' else variables[name]
+        return _field_path(value, path) if path else value
+    if isinstance(expression, str) and expression.startswith('$'):
+        return _field_path(document, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(item, document, variables) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+    if len(expression) != 1 or not next(iter(expression)).startswith('$'):
+        return {key: evaluate(value, document, variables) for key, value in expression.items()}
+
+    operator, argument = next(iter(expression.items()))
+    if operator == '$literal':
+        return argument
+    if operator == '$map':
+        name = argument.get('as', 'this')
+        items = evaluate(argument['input'], document, variables)
+        if items is None:
+            return None
+        return [evaluate(argument['in'], document, {**variables, name: item}) for item in items]
+    if operator == '$cond':
+        if isinstance(argument, dict):
+            argument = [argument['if'], argument['then'], argument['else']]
+        condition, then, otherwise = argument
+        return evaluate(then if evaluate(condition, document, variables) else otherwise, document, variables)
+
+    arguments = [evaluate(item, document, variables) for item in (argument if isinstance(argument, list) else [argument])]
+    if operator == '$eq':
+        return arguments[0] == arguments[1]
+    if operator == '$ne':
+        return arguments[0] != arguments[1]
+    if operator == '$ifNull':
+        return next((value for value in arguments if value is not None), arguments[-1])
+    if operator == '$mergeObjects':
+        result = {}
+        for value in arguments:
+            result.update(value or {})
+        return result
+    if operator == '$concatArrays':
+        if any(value is None for value in arguments):
+            return None
+        return [item for value in arguments for item in value]
+    if operator == '$arrayElemAt':
+        array, index = arguments
+        return array[index] if -len(array) <= index < len(array) else None
+    if operator == '$indexOfArray':
+        array, value = arguments[:2]
+        return array.index(value) if value in array else -1
+    if operator == '$size':
+        return len(arguments[0])
+    raise NotImplementedError(f'expression operator {operator} is not supported')
+
+
+def apply_update(document, update):
+    """Apply an update document or an update pipeline to `document` in place."""
+    if not isinstance(update, list):
+        _apply_operators(document, update)
+        return
+    for stage in update:
+        for operator, argument in stage.items():
+            if operator in ('$set', '$addFields'):
+                values = {path: evaluate(expression, document) for path, expression in argument.items()}
+                for path, value in values.items():
+                    _set(document, path, value)
+            elif operator == '$unset':
+                for path in [argument] if isinstance(argument, str) else argument:
+                    _unset(document, path)
+            else:
+                raise NotImplementedError(f'pipeline stage {operator} is not supported')
+
+
+def _merge(target, key, value):
+    if isinstance(value, dict) and isinstance(target.get(key), dict):
+        for inner_key, inner_value in value.items():
+            _merge(target[key], inner_key, inner_value)
+    elif isinstance(value, list) and isinstance(target.get(key), list):
+        for target_item, item in zip(target[key], value):
+            for inner_key, inner_value in item.items():
+                _merge(target_item, inner_key, inner_value)
+    else:
+        target[key] = value
+
+
+def _project_path(document, parts):
+    head, rest = parts[0], parts[1:]
+    if head not in document:
+        return MISSING
+    value = document[head]
+    if not rest:
+        return deepcopy(value)
+    if isinstance(value, list):
+        return [
+            {key: v for key, v in [(rest[0], _project_path(item, rest))] if v is not MISSING}
+            for item in value if isinstance(item, dict)
+        ]
+    if isinstance(value, dict):
+        inner = _project_path(value, rest)
+        return MISSING if inner is MISSING else {rest[0]: inner}
+    return MISSING
+
+
+def _slice(array, argument):
+    if isinstance(argument, int):
+        return array[:argument] if argument >= 0 else array[argument:]
+    skip, limit = argument
+    start = skip if skip >= 0 else max(len(array) + skip, 0)
+    return array[start:start + limit]
+
+
+def project(document, projection):
+    """Copy of `document` restricted by an inclusion projection with `$elemMatch` and `$slice` support."""
+    if projection is None:
+        return deepcopy(document)
+
+    included = {
+        field: spec for field, spec in projection.items()
+        if field != '_id' and not isinstance(spec, dict) and spec
+    }
+    operators = {field: spec for field, spec in projection.items() if isinstance(spec, dict)}
+    sliced_only = not included and all('$slice' in spec for spec in operators.values()) and operators
+
+    result = deepcopy(document) if sliced_only else {}
+    if not sliced_only:
+        for field in included:
+            value = _project_path(document, field.split('.'))
+            if value is not MISSING:
+                _merge(result, field.split('.')[0], value)
+
+    for field, spec in operators.items():
+        array = document.get(field)
+        if not isinstance(array, list):
+            continue
+        if '$elemMatch' in spec:
+            element = next((item for item in array if isinstance(item, dict) and matches(item, spec['$elemMatch'])), None)
+            if element is not None:
+                result[field] = [deepcopy(element)]
+            else:
+                result.pop(field, None)
+        elif '$slice' in spec:
+            result[field] = deepcopy(_slice(array, spec['$slice']))
+
+    if projection.get('_id', True) and '_id' in document:
+        result['_id'] = document['_id']
+    else:
+        result.pop('_id', None)
+    return result
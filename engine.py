@@ -0,0 +1,269 @@
+"""Games kept in process memory, with the database written behind.
+
+With GAME_ENGINE enabled `games` is a GameEngine instead of the `games`
+collection. It answers the calls the bot makes on the collection (the query,
+update and projection operators are those of documents.py) from a dictionary
+of games indexed by id and chat, so handlers and stages do not wait for the
+database. Every write is appended to a journal that is inserted into the
+`journal` collection every ENGINE_FLUSH_INTERVAL seconds. Every
+ENGINE_SNAPSHOT_INTERVAL seconds the changed games are written back to the
+`games` collection and the journal they include is dropped. On start,
+`recover` rebuilds the games from the collection and the newer journal.
+
+Writes of the last flush interval before a crash are lost, and the games
+exist in one process only, so the engine cannot run on several instances.
+"""
+
+import config
+from .logger import logger
+from .database import database
+from .documents import matches, apply_update, project
+
+import atexit
+from time import time, sleep
+from copy import deepcopy
+from threading import Lock
+from bson import ObjectId, json_util
+from pymongo import ASCENDING, ReplaceOne, DeleteOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from pymongo.results import InsertOneResult, UpdateResult, DeleteResult
+
+
+class GameEngine:
+    """In-memory replacement for the `games` collection with a write-behind journal.
+
+    Journal entries have the sequence number of the write as `_id`, the id
+    of the `game` and the `op` with its `payload`: the inserted document or
+    the update. The `snapshot` document of the journal holds the sequence
+    number the `games` collection is up to date with.
+    """
+
+    def __init__(self, flush_interval, snapshot_interval):
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self._games = {}
+        self._chats = {}
+        self._pending = []
+        self._dirty = set()
+        self._seq = 0
+        self._recovered = False
+        self._lock = Lock()
+        self._write_lock = Lock()
+
+    def _index(self, game):
+        self._games[game['_id']] = game
+        self._chats.setdefault(game.get('chat'), set()).add(game['_id'])
+
+    def _unindex(self, game):
+        del self._games[game['_id']]
+        ids = self._chats[game.get('chat')]
+        ids.discard(game['_id'])
+        if not ids:
+            del self._chats[game.get('chat')]
+
+    def _journal(self, op, game_id, payload=None):
+        self._seq += 1
+        entry = {'_id': self._seq, 'game': game_id, 'op': op, 'time': time()}
+        if payload is not None:
+            entry['payload'] = payload
+        self._pending.append(entry)
+        self._dirty.add(game_id)
+
+    def _candidates(self, filter):
+        game_id = filter.get('_id')
+        if isinstance(game_id, dict):
+            if set(game_id) == {'$in'}:
+                return [self._games[i] for i in game_id['$in'] if i in self._games]
+        elif game_id is not None:
+            return [self._games[game_id]] if game_id in self._games else []
+        chat = filter.get('chat')
+        if chat is not None and not isinstance(chat, dict):
+            return [self._games[i] for i in self._chats.get(chat, ())]
+        return list(self._games.values())
+
+    def _select(self, filter):
+        filter = filter or {}
+        return (game for game in self._candidates(filter) if matches(game, filter))
+
+    def _update(self, game, update):
+        updated = deepcopy(game)
+        apply_update(updated, update)
+        if updated == game:
+            return game
+        self._unindex(game)
+        self._index(updated)
+        self._journal('update', game['_id'], deepcopy(update))
+        return updated
+
+    def _delete(self, game):
+        self._unindex(game)
+        self._journal('delete', game['_id'])
+
+    def find_one(self, filter=None, projection=None):
+        with self._lock:
+            game = next(self._select(filter), None)
+            return None if game is None else project(game, projection)
+
+    def find(self, filter=None, projection=None):
+        with self._lock:
+            return [project(game, projection) for game in self._select(filter)]
+
+    def insert_one(self, document):
+        document.setdefault('_id', ObjectId())
+        game = deepcopy(document)
+        with self._lock:
+            if game['_id'] in self._games:
+                raise DuplicateKeyError(f'duplicate key: {game["_id"]}')
+            self._index(game)
+            self._journal('insert', game['_id'], deepcopy(game))
+        return InsertOneResult(document['_id'], True)
+
+    def update_one(self, filter, update):
+        with self._lock:
+            game = next(self._select(filter), None)
+            if game is None:
+                return UpdateResult({'n': 0, 'nModified': 0}, True)
+            modified = self._update(game, update) is not game
+        return UpdateResult({'n': 1, 'nModified': int(modified)}, True)
+
+    def update_many(self, filter, update):
+        with self._lock:
+            selected = list(self._select(filter))
+            modified = sum(self._update(game, update) is not game for game in selected)
+        return UpdateResult({'n': len(selected), 'nModified': modified}, True)
+
+    def find_one_and_update(self, filter, update, projection=None, return_document=False):
+        with self._lock:
+            game = next(self._select(filter), None)
+            if game is None:
+                return None
+            updated = self._update(game, update)
+            return project(updated if return_document else game, projection)
+
+    def delete_one(self, filter):
+        with self._lock:
+            game = next(self._select(filter), None)
+            if game is not None:
+                self._delete(game)
+        return DeleteResult({'n': int(game is not None)}, True)
+
+    def delete_many(self, filter):
+        with self._lock:
+            selected = list(self._select(filter))
+            for game in selected:
+                self._delete(game)
+        return DeleteResult({'n': len(selected)}, True)
+
+    def recover(self):
+        """Load the games from the last snapshot and replay the journal written after it."""
+        snapshot = database.journal.find_one({'_id': 'snapshot'}) or {'seq': 0}
+        games, seqs = {}, {}
+        for game in database.games.find():
+            seqs[game['_id']] = game.pop('_seq', 0)
+            games[game['_id']] = game
+
+        seq = max([snapshot['seq'], *seqs.values()])
+        replayed = set()
+        for entry in database.journal.find({'_id': {'$gt': snapshot['seq']}}).sort('_id', ASCENDING):
+            seq = max(seq, entry['_id'])
+            # A snapshot interrupted before its `snapshot` document was written already includes some entries
+            if entry['_id'] <= seqs.get(entry['game'], 0):
+                continue
+            payload = json_util.loads(entry['payload']) if 'payload' in entry else None
+            if entry['op'] == 'insert':
+                games[entry['game']] = payload
+            elif entry['op'] == 'update' and entry['game'] in games:
+                apply_update(games[entry['game']], payload)
+            elif entry['op'] == 'delete':
+                games.pop(entry['game'], None)
+            replayed.add(entry['game'])
+
+        with self._lock:
+            self._games, self._chats = {}, {}
+            for game in games.values():
+                self._index(game)
+            self._seq = seq
+            self._dirty = replayed
+            self._recovered = True
+        atexit.register(self.snapshot)
+        logger.info('Восстановлено игр: %s, из журнала: %s', len(games), len(replayed))
+
+    def flush(self):
+        """Insert the journal entries written since the last flush."""
+        with self._write_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if not entries:
+            return
+        documents = [
+            {**entry, 'payload': json_util.dumps(entry['payload'])} if 'payload' in entry else entry
+            for entry in entries
+        ]
+        try:
+            database.journal.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            # Entries inserted by an earlier attempt that failed midway
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                self._requeue(entries)
+                raise
+        except PyMongoError:
+            self._requeue(entries)
+            raise
+
+    def _requeue(self, entries):
+        with self._lock:
+            self._pending[:0] = entries
+
+    def snapshot(self):
+        """Write the games changed since the last snapshot and drop the journal they include."""
+        if not self._recovered:
+            return
+        with self._write_lock:
+            with self._lock:
+                seq = self._seq
+                dirty, self._dirty = self._dirty, set()
+                games = {game_id: deepcopy(self._games[game_id]) for game_id in dirty if game_id in self._games}
+            if not dirty:
+                self._flush()
+                return
+
+            try:
+                self._flush()
+                database.games.bulk_write([
+                    ReplaceOne({'_id': game_id}, {**games[game_id], '_seq': seq}, upsert=True)
+                    if game_id in games else DeleteOne({'_id': game_id})
+                    for game_id in dirty
+                ], ordered=False)
+                database.journal.update_one({'_id': 'snapshot'}, {'$set': {'seq': seq, 'time': time()}}, upsert=True)
+            except PyMongoError:
+                with self._lock:
+                    self._dirty |= dirty
+                raise
+            database.journal.delete_many({'_id': {'$lte': seq}})
+            logger.debug('Записан снимок игр: %s, журнал до %s', len(dirty), seq)
+
+    def run(self):
+        next_snapshot = time() + self.snapshot_interval
+        while True:
+            sleep(self.flush_interval)
+            try:
+                if time() >= next_snapshot:
+                    next_snapshot = time() + self.snapshot_interval
+                    self.snapshot()
+                else:
+                    self.flush()
+            except PyMongoError:
+                logger.exception('Не удалось записать журнал игр')
+
+
+if getattr(config, 'GAME_ENGINE', False) and getattr(config, 'LEADER_LEASE', False):
+    raise RuntimeError('GAME_ENGINE keeps games in the memory of one instance and cannot be used with LEADER_LEASE')
+
+engine = GameEngine(
+    flush_interval=getattr(config, 'ENGINE_FLUSH_INTERVAL', 0.5),
+    snapshot_interval=getattr(config, 'ENGINE_SNAPSHOT_INTERVAL', 60)
+) if getattr(config, 'GAME_ENGINE', False) else None
+games = database.games if engine is None else engine
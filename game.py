@@ -14,7 +14,9 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 from .bot import bot
-from .database import database
+from .engine import games
+from .scheduler import scheduler
+from .cache import game_cache
 
 
 role_titles = {
@@ -25,10 +27,24 @@ role_titles = {
 }
 
 
+def stage_filter(game):
+    """Filter matching `game` only while it is still at the stage and deadline it was read with."""
+    return {'_id': game['_id'], 'stage': game['stage'], 'next_stage_time': game.get('next_stage_time')}
+
+
 def stop_game(game, reason):
+    """End the game if it is still where `game` found it, and return whether it did.
+
+    Of concurrent callers ending or advancing the same game, only one wins,
+    so the results are announced and counted once.
+    """
+    if not games.delete_one(stage_filter(game)).deleted_count:
+        return False
+    game_cache.invalidate(game['chat'])
+    scheduler.cancel(game['_id'])
     bot.try_to_send_message(
         game['chat'],
         f'Игра окончена! {reason}\n\nРоли были распределены следующим образом:\n' +
         '\n'.join([f'{i+1}. {p["name"]} - {role_titles[p.get("role", "?")]}' for i, p in enumerate(game['players'])])
     )
-    database.games.delete_one({'_id': game['_id']})
+    return True
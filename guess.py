@@ -0,0 +1,39 @@
+import re
+
+
+def normalize(text):
+    return text.lower().replace('ё', 'е')
+
+
+class GuessMatcher:
+    """Search for the hidden word compiled once per game.
+
+    The word matches as a whole, regardless of case and ё/е, and parts of a
+    compound word may be separated by any punctuation or none at all.
+    """
+
+    def __init__(self, word):
+        parts = [part for part in re.split(r'[\W_]+', normalize(word)) if part]
+        pattern = r'[\W_]*'.join(map(re.escape, parts))
+        self._regex = re.compile(rf'(?<!\w){pattern}(?!\w)')
+
+    def matches(self, text):
+        return self._regex.search(normalize(text)) is not None
+
+
+_matchers = {}
+
+
+def get_matcher(game):
+    matcher = _matchers.get(game['_id'])
+    if matcher is None:
+        matcher = _matchers[game['_id']] = GuessMatcher(game['word'])
+    return matcher
+
+
+def discard_matcher(game):
+    _matchers.pop(game['_id'], None)
+
+
+def clear_matchers():
+    _matchers.clear()
@@ -1,15 +1,24 @@
 import config
 from .database import database
+from .engine import games
 from . import lang
 from . import croco
 from . import gallows
 from .game import role_titles, stop_game
 from .stages import stages, go_to_next_stage, format_roles, get_votes
+from .scheduler import scheduler
+from .timers import timers
+from .cache import game_cache
+from .stats import get_leaderboard
+from .guess import clear_matchers
+from .view import find_game, game_projection, view
+from .profiler import profiler, format_top
 from .bot import bot
 
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 import re
+import html
 import random
 from time import time
 from uuid import uuid4
@@ -32,15 +41,15 @@ def user_object(user):
     return {'id': user.id, 'name': get_name(user), 'full_name': get_full_name(user)}
 
 
-def command_regexp(command):
-    return f'^/{command}(@{bot.get_me().username})?$'
+def is_admin(message):
+    return message.from_user.id == config.ADMIN_ID
 
 
-@bot.message_handler(regexp=command_regexp('help'))
-@bot.message_handler(func=lambda message: message.chat.type == 'private', commands=['start'])
+@bot.command_handler('help')
+@bot.command_handler('start', func=lambda message: message.chat.type == 'private')
 def start_command(message, *args, **kwargs):
     answer = (
-        f'Привет, я {bot.get_me().first_name}!\n'
+        f'Привет, я {bot.identity.first_name}!\n'
         'Я умею создавать игры в мафию в группах и супергруппах.\n'
         'Инструкция и исходный код: https://gitlab.com/r4rdsn/mafia_host_bot\n'
         'По всем вопросам пишите на https://t.me/r4rdsn'
@@ -59,7 +68,7 @@ def get_croco_score(stats):
     return result / 25
 
 
-@bot.message_handler(regexp=command_regexp('stats'))
+@bot.command_handler('stats')
 def stats_command(message, *args, **kwargs):
     stats = database.stats.find_one({'id': message.from_user.id, 'chat': message.chat.id})
 
@@ -115,38 +124,19 @@ def stats_command(message, *args, **kwargs):
     bot.send_message(message.chat.id, '\n\n'.join(paragraphs))
 
 
-def update_rating(rating, name, score, maxlen):
-    place = None
-    for i, (_, rating_score) in enumerate(rating):
-        if score > rating_score:
-            place = i
-            break
-    if place is not None:
-        rating.insert(place, (name, score))
-        if len(rating) > maxlen:
-            rating.pop(-1)
-    elif len(rating) < maxlen:
-        rating.append((name, score))
-
-
 def get_rating_list(rating):
     return '\n'.join(f'{i + 1}. {n}: {s}' for i, (n, s) in enumerate(rating))
-@bot.message_handler(regexp=command_regexp('rating'))
+
+
+@bot.command_handler('rating')
 def rating_command(message, *args, **kwargs):
-    chat_stats = database.stats.find({'chat': message.chat.id})
+    mafia_rating = [(s['name'], s['mafia_score']) for s in get_leaderboard(message.chat.id, 'mafia_score', 5)]
+    croco_rating = [(s['name'], s['croco_score'] / 25) for s in get_leaderboard(message.chat.id, 'croco_score', 3)]
 
-    if not chat_stats:
+    if not mafia_rating and not croco_rating:
         bot.send_message(message.chat.id, 'Статистика чата пуста.')
         return
 
-    mafia_rating = []
-    croco_rating = []
-    for stats in chat_stats:
-        if 'total' in stats:
-            update_rating(mafia_rating, stats['name'], get_mafia_score(stats), 5)
-        if 'croco' in stats:
-            update_rating(croco_rating, stats['name'], get_croco_score(stats), 3)
-
     paragraphs = []
     if mafia_rating:
         paragraphs.append('Рейтинг игроков в мафию:\n' + get_rating_list(mafia_rating))
@@ -156,12 +146,12 @@ def rating_command(message, *args, **kwargs):
     bot.send_message(message.chat.id, '\n\n'.join(paragraphs))
 
 
-@bot.group_message_handler(regexp=command_regexp('croco'))
+@bot.group_command_handler('croco')
 def play_croco(message, game, *args, **kwargs):
     if game:
         bot.send_message(message.chat.id, 'Игра в этом чате уже идёт.')
         return
-    word = croco.get_word()[:-2]
+    word = croco.get_word()
     id = str(uuid4())[:8]
     keyboard = InlineKeyboardMarkup()
     keyboard.add(
@@ -171,7 +161,7 @@ def play_croco(message, game, *args, **kwargs):
         )
     )
     name = get_name(message.from_user)
-    database.games.insert_one({
+    game = {
         'game': 'croco',
         'id': id,
         'player': message.from_user.id,
@@ -181,7 +171,10 @@ def play_croco(message, game, *args, **kwargs):
         'chat': message.chat.id,
         'time': time() + 60,
         'stage': 0
-    })
+    }
+    games.insert_one(game)
+    game_cache.invalidate(message.chat.id)
+    timers.add('croco', game['_id'], game['time'])
     bot.send_message(
         message.chat.id,
         f'Игра началась! {name.capitalize()}, у тебя есть две минуты, чтобы объяснить слово.',
@@ -189,7 +182,7 @@ def play_croco(message, game, *args, **kwargs):
     )
 
 
-@bot.group_message_handler(regexp=command_regexp('gallows'))
+@bot.group_command_handler('gallows')
 def play_gallows(message, game, *args, **kwargs):
     if game:
         if game['game'] == 'gallows':
@@ -197,7 +190,7 @@ def play_gallows(message, game, *args, **kwargs):
         else:
             bot.send_message(message.chat.id, 'Игра в этом чате уже идёт.')
         return
-    word = croco.get_word()[:-2]
+    word = croco.get_word()
     sent_message = bot.send_message(
         message.chat.id,
         lang.gallows.format(
@@ -205,7 +198,7 @@ def play_gallows(message, game, *args, **kwargs):
         ) % gallows.stickman[0],
         parse_mode='HTML'
     )
-    database.games.insert_one({
+    games.insert_one({
         'game': 'gallows',
         'chat': message.chat.id,
         'word': word,
@@ -214,12 +207,14 @@ def play_gallows(message, game, *args, **kwargs):
         'names': {},
         'message_id': sent_message.message_id
     })
+    game_cache.invalidate(message.chat.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('get_word'))
+@bot.callback_handler('get_word')
 def get_word(call):
-    game = database.games.find_one(
-        {'game': 'croco', 'id': call.data.split()[1], 'player': call.from_user.id}
+    game = find_game(
+        {'game': 'croco', 'id': call.data.split()[1], 'player': call.from_user.id},
+        ('word',)
     )
     if game:
         bot.answer_callback_query(
@@ -235,20 +230,44 @@ def get_word(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'take card')
+@bot.callback_handler('take card')
 def take_card(call):
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'stage': -4,
-        'players.id': call.from_user.id,
-        'chat': call.message.chat.id,
-    })
+    fields = ('chat', 'stage', 'next_stage_time', 'players')
+    player_game = view(games.find_one_and_update(
+        {
+            'game': 'mafia',
+            'stage': -4,
+            'players': {'$elemMatch': {'id': call.from_user.id, 'role': None}},
+            'chat': call.message.chat.id,
+        },
+        [{'$set': {'players': {'$map': {
+            'input': '$players',
+            'as': 'player',
+            'in': {'$cond': [
+                {'$eq': ['$$player.id', call.from_user.id]},
+                {'$mergeObjects': ['$$player', {'role': {'$arrayElemAt': [
+                    '$cards', {'$indexOfArray': ['$players.id', call.from_user.id]}
+                ]}}]},
+                '$$player'
+            ]}
+        }}}}],
+        projection=game_projection(fields),
+        return_document=ReturnDocument.AFTER
+    ), fields)
 
     if player_game:
-        player_index = next(i for i, p in enumerate(player_game['players']) if p['id'] == call.from_user.id)
-        player_object = player_game['players'][player_index]
+        game_cache.invalidate(player_game['chat'])
+        player_role = next(p['role'] for p in player_game['players'] if p['id'] == call.from_user.id)
 
-        if player_object.get('role') is None:
+        bot.answer_callback_query(
+            callback_query_id=call.id,
+            show_alert=True,
+            text=f'Твоя роль - {role_titles[player_role]}.'
+        )
+
+        players_without_roles = [i + 1 for i, p in enumerate(player_game['players']) if p.get('role') is None]
+
+        if len(players_without_roles) > 0:
             keyboard = InlineKeyboardMarkup()
             keyboard.add(
                 InlineKeyboardButton(
@@ -257,52 +276,41 @@ def take_card(call):
                 )
             )
 
-            player_role = player_game['cards'][player_index]
+            bot.coalesce_edit_message_text(
+                lang.take_card.format(
+                    order=format_roles(player_game),
+                    not_took=', '.join(map(str, players_without_roles))),
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                reply_markup=keyboard
+            )
 
-            player_game = database.games.find_one_and_update(
+        else:
+            games.update_one(
                 {'_id': player_game['_id']},
-                {'$set': {f'players.{player_index}.role': player_role}},
-                return_document=ReturnDocument.AFTER
+                {'$set': {'order': []}}
             )
+            game_cache.invalidate(player_game['chat'])
 
-            bot.answer_callback_query(
-                callback_query_id=call.id,
-                show_alert=True,
-                text=f'Твоя роль - {role_titles[player_role]}.'
+            bot.coalesce_edit_message_text(
+                'Порядок игроков для игры следующий:\n\n' + format_roles(player_game),
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
             )
 
-            players_without_roles = [i + 1 for i, p in enumerate(player_game['players']) if p.get('role') is None]
-
-            if len(players_without_roles) > 0:
-                bot.edit_message_text(
-                    lang.take_card.format(
-                        order=format_roles(player_game),
-                        not_took=', '.join(map(str, players_without_roles))),
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    reply_markup=keyboard
-                )
-
-            else:
-                database.games.update_one(
-                    {'_id': player_game['_id']},
-                    {'$set': {'order': []}}
-                )
+            go_to_next_stage(player_game, inc=2)
 
-                bot.edit_message_text(
-                    'Порядок игроков для игры следующий:\n\n' + format_roles(player_game),
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                )
-
-                go_to_next_stage(player_game, inc=2)
-
-        else:
-            bot.answer_callback_query(
-                callback_query_id=call.id,
-                show_alert=False,
-                text='У тебя уже есть роль.'
-            )
+    elif find_game({
+        'game': 'mafia',
+        'stage': -4,
+        'players.id': call.from_user.id,
+        'chat': call.message.chat.id,
+    }, ()):
+        bot.answer_callback_query(
+            callback_query_id=call.id,
+            show_alert=False,
+            text='У тебя уже есть роль.'
+        )
 
     else:
         bot.answer_callback_query(
@@ -312,16 +320,16 @@ def take_card(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'mafia team')
+@bot.callback_handler('mafia team')
 def mafia_team(call):
-    player_game = database.games.find_one({
+    player_game = find_game({
         'game': 'mafia',
         'players': {'$elemMatch': {
             'id': call.from_user.id,
             'role': {'$in': ['don', 'mafia']},
         }},
         'chat': call.message.chat.id
-    })
+    }, ('players.name', 'players.role'))
 
     if player_game:
         bot.answer_callback_query(
@@ -338,32 +346,36 @@ def mafia_team(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('check don'))
+@bot.callback_handler('check don')
 def check_don(call):
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'stage': 5,
-        'players': {'$elemMatch': {
-            'alive': True,
-            'role': 'don',
-            'id': call.from_user.id
-        }},
-        'chat': call.message.chat.id
-    })
+    check_player = int(re.match(r'check don (\d+)', call.data).group(1)) - 1
+    player_game = games.find_one_and_update(
+        {
+            'game': 'mafia',
+            'stage': 5,
+            'players': {'$elemMatch': {
+                'alive': True,
+                'role': 'don',
+                'id': call.from_user.id
+            }},
+            'played': {'$ne': call.from_user.id},
+            'chat': call.message.chat.id
+        },
+        {'$addToSet': {'played': call.from_user.id}},
+        projection={'chat': True, 'players': {'$slice': [check_player, 1]}}
+    )
 
-    if player_game and call.from_user.id not in player_game['played']:
-        check_player = int(re.match(r'check don (\d+)', call.data).group(1)) - 1
+    if player_game:
+        game_cache.invalidate(player_game['chat'])
 
         bot.answer_callback_query(
             callback_query_id=call.id,
             show_alert=True,
             text=f'Да, игрок под номером {check_player + 1} - {role_titles["sheriff"]}'
-                 if player_game['players'][check_player]['role'] == 'sheriff' else
+                 if player_game['players'][0]['role'] == 'sheriff' else
                  f'Нет, игрок под номером {check_player + 1} - не {role_titles["sheriff"]}'
         )
 
-        database.games.update_one({'_id': player_game['_id']}, {'$addToSet': {'played': call.from_user.id}})
-
     else:
         bot.answer_callback_query(
             callback_query_id=call.id,
@@ -372,34 +384,39 @@ def check_don(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('check sheriff'))
+@bot.callback_handler('check sheriff')
 def check_sheriff(call):
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'stage': 6,
-        'players': {'$elemMatch': {
-            'alive': True,
-            'role': 'sheriff',
-            'id': call.from_user.id
-        }},
-        'chat': call.message.chat.id
-    })
+    check_player = int(re.match(r'check sheriff (\d+)', call.data).group(1)) - 1
+    player_game = games.find_one_and_update(
+        {
+            'game': 'mafia',
+            'stage': 6,
+            'players': {'$elemMatch': {
+                'alive': True,
+                'role': 'sheriff',
+                'id': call.from_user.id
+            }},
+            'played': {'$ne': call.from_user.id},
+            'chat': call.message.chat.id
+        },
+        {'$addToSet': {'played': call.from_user.id}},
+        projection={'chat': True, 'players': {'$slice': [check_player, 1]}}
+    )
 
-    if player_game and call.from_user.id not in player_game['played']:
-        check_player = int(re.match(r'check sheriff (\d+)', call.data).group(1)) - 1
+    if player_game:
+        game_cache.invalidate(player_game['chat'])
+        check_role = player_game['players'][0]['role']
 
         bot.answer_callback_query(
             callback_query_id=call.id,
             show_alert=True,
             text=f'Да, игрок под номером {check_player + 1} - {role_titles["don"]}'
-                 if player_game['players'][check_player]['role'] == 'don' else
+                 if check_role == 'don' else
                  f'Да, игрок под номером {check_player + 1} - {role_titles["mafia"]}'
-                 if player_game['players'][check_player]['role'] == 'mafia' else
+                 if check_role == 'mafia' else
                  f'Нет, игрок под номером {check_player + 1} - не {role_titles["mafia"]}'
         )
 
-        database.games.update_one({'_id': player_game['_id']}, {'$addToSet': {'played': call.from_user.id}})
-
     else:
         bot.answer_callback_query(
             callback_query_id=call.id,
@@ -408,9 +425,9 @@ def check_sheriff(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('append to order'))
+@bot.callback_handler('append to order')
 def append_order(call):
-    player_game = database.games.find_one({
+    player_game = find_game({
         'game': 'mafia',
         'stage': -2,
         'players': {'$elemMatch': {
@@ -418,15 +435,16 @@ def append_order(call):
             'id': call.from_user.id
         }},
         'chat': call.message.chat.id
-    })
+    }, ('chat',))
 
     if player_game:
         call_player = re.match(r'append to order (\d+)', call.data).group(1)
 
-        database.games.update_one(
+        games.update_one(
             {'_id': player_game['_id']},
             {'$addToSet': {'order': call_player}}
         )
+        game_cache.invalidate(player_game['chat'])
 
         bot.answer_callback_query(
             callback_query_id=call.id,
@@ -442,30 +460,34 @@ def append_order(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('vote'))
+@bot.callback_handler('vote')
 def vote(call):
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'stage': 1,
-        'players': {'$elemMatch': {
-            'alive': True,
-            'id': call.from_user.id
-        }},
-        'chat': call.message.chat.id
-    })
-
-    if player_game and call.from_user.id not in player_game['played']:
-        vote_player = int(re.match(r'vote (\d+)', call.data).group(1)) - 1
-        player_index = next(i for i, p in enumerate(player_game['players']) if p['id'] == call.from_user.id)
-
-        game = database.games.find_one_and_update(
-            {'_id': player_game['_id']},
-            {'$addToSet': {
-                'played': call.from_user.id,
-                'vote.%d' % vote_player: player_index
+    vote_player = int(re.match(r'vote (\d+)', call.data).group(1)) - 1
+    fields = ('chat', 'message_id', 'players', 'vote')
+    game = view(games.find_one_and_update(
+        {
+            'game': 'mafia',
+            'stage': 1,
+            'players': {'$elemMatch': {
+                'alive': True,
+                'id': call.from_user.id
             }},
-            return_document=ReturnDocument.AFTER
-        )
+            'played': {'$ne': call.from_user.id},
+            'chat': call.message.chat.id
+        },
+        [{'$set': {
+            'played': {'$concatArrays': ['$played', [call.from_user.id]]},
+            'vote.%d' % vote_player: {'$concatArrays': [
+                {'$ifNull': ['$vote.%d' % vote_player, []]},
+                [{'$indexOfArray': ['$players.id', call.from_user.id]}]
+            ]}
+        }}],
+        projection=game_projection(fields),
+        return_document=ReturnDocument.AFTER
+    ), fields)
+
+    if game:
+        game_cache.invalidate(game['chat'])
 
         keyboard = InlineKeyboardMarkup(row_width=8)
         keyboard.add(
@@ -480,7 +502,7 @@ def vote(call):
                 callback_data='vote 0'
             )
         )
-        bot.edit_message_text(
+        bot.coalesce_edit_message_text(
             lang.vote.format(vote=get_votes(game)),
             chat_id=game['chat'],
             message_id=game['message_id'],
@@ -501,9 +523,9 @@ def vote(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'end order')
+@bot.callback_handler('end order')
 def end_order(call):
-    player_game = database.games.find_one({
+    player_game = find_game({
         'game': 'mafia',
         'stage': -2,
         'players': {'$elemMatch': {
@@ -511,7 +533,7 @@ def end_order(call):
             'id': call.from_user.id
         }},
         'chat': call.message.chat.id
-    })
+    }, ('chat', 'stage', 'next_stage_time'))
 
     if player_game:
         bot.answer_callback_query(
@@ -530,11 +552,9 @@ def end_order(call):
         )
 
 
-@bot.callback_query_handler(
-    func=lambda call: call.data == 'get order',
-)
+@bot.callback_handler('get order')
 def get_order(call):
-    player_game = database.games.find_one({
+    player_game = find_game({
         'game': 'mafia',
         '$or': [
             {'players': {'$elemMatch': {
@@ -547,7 +567,7 @@ def get_order(call):
             }}}
         ],
         'chat': call.message.chat.id
-    })
+    }, ('order',))
 
     if player_game:
         if player_game.get('order'):
@@ -569,7 +589,7 @@ def get_order(call):
         )
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'request interact')
+@bot.callback_handler('request interact')
 def request_interact(call):
     message_id = call.message.message_id
     required_request = database.requests.find_one({'message_id': message_id})
@@ -612,6 +632,8 @@ def request_interact(call):
             update_dict,
             return_document=ReturnDocument.AFTER
         )
+        if '$set' in update_dict:
+            timers.add('request', updated_document['_id'], updated_document['time'])
 
         keyboard = InlineKeyboardMarkup()
         keyboard.add(
@@ -621,7 +643,7 @@ def request_interact(call):
             )
         )
 
-        bot.edit_message_text(
+        bot.coalesce_edit_message_text(
             lang.new_request.format(
                 owner=updated_document['owner']['name'],
                 time=datetime.utcfromtimestamp(updated_document['time']).strftime('%H:%M'),
@@ -638,13 +660,13 @@ def request_interact(call):
         bot.edit_message_text('Заявка больше не существует.', chat_id=call.message.chat.id, message_id=message_id)
 
 
-@bot.group_message_handler(regexp=command_regexp('create'))
+@bot.group_command_handler('create')
 def create(message, *args, **kwargs):
     existing_request = database.requests.find_one({'chat': message.chat.id})
     if existing_request:
         bot.send_message(message.chat.id, 'В этом чате уже есть игра!', reply_to_message_id=existing_request['message_id'])
         return
-    existing_game = database.games.find_one({'chat': message.chat.id, 'game': 'mafia'})
+    existing_game = games.find_one({'chat': message.chat.id, 'game': 'mafia'})
     if existing_game:
         bot.send_message(message.chat.id, 'В этом чате уже идёт игра!')
         return
@@ -668,7 +690,7 @@ def create(message, *args, **kwargs):
     )
     sent_message = bot.send_message(message.chat.id, answer, reply_markup=keyboard)
 
-    database.requests.insert_one({
+    request = {
         'id': str(uuid4())[:8],
         'owner': player_object,
         'players': [player_object],
@@ -676,10 +698,12 @@ def create(message, *args, **kwargs):
         'chat': message.chat.id,
         'message_id': sent_message.message_id,
         'players_count': 1
-    })
+    }
+    database.requests.insert_one(request)
+    timers.add('request', request['_id'], request['time'])
 
 
-@bot.group_message_handler(regexp=command_regexp('start'))
+@bot.group_command_handler('start')
 def start_game(message, *args, **kwargs):
     req = database.requests.find_and_modify(
         {
@@ -716,7 +740,7 @@ def start_game(message, *args, **kwargs):
             reply_markup=keyboard
         ).message_id
 
-        database.games.insert_one({
+        game = {
             'game': 'mafia',
             'chat': req['chat'],
             'id': req['id'],
@@ -730,13 +754,16 @@ def start_game(message, *args, **kwargs):
             'vote': {},
             'shots': [],
             'played': []
-        })
+        }
+        games.insert_one(game)
+        game_cache.invalidate(req['chat'])
+        scheduler.schedule(game['_id'], game['next_stage_time'])
 
     else:
         bot.send_message(message.chat.id, 'У тебя нет заявки на игру, которую возможно начать.')
 
 
-@bot.group_message_handler(regexp=command_regexp('cancel'))
+@bot.group_command_handler('cancel')
 def cancel(message, *args, **kwargs):
     req = database.requests.find_one_and_delete({
         'owner.id': message.from_user.id,
@@ -750,7 +777,7 @@ def cancel(message, *args, **kwargs):
 
 
 def create_poll(message, game, poll_type, suggestion):
-    if not game or game['stage'] not in (0, -4):
+    if not game or game['game'] != 'mafia' or game['stage'] not in (0, -4):
         return
 
     check_roles = game['stage'] == 0
@@ -775,6 +802,10 @@ def create_poll(message, game, poll_type, suggestion):
         'votes': [message.from_user.id],
     }
 
+    game = find_game({'_id': game['_id']}, ('players.id', 'players.alive', 'players.role'))
+    if not game:
+        return
+
     keyboard = InlineKeyboardMarkup()
     if check_roles:
         peace_team = set()
@@ -815,17 +846,17 @@ def create_poll(message, game, poll_type, suggestion):
     database.polls.insert_one(poll)
 
 
-@bot.group_message_handler(regexp=command_regexp('end'))
+@bot.group_command_handler('end')
 def force_game_end(message, game, *args, **kwargs):
     create_poll(message, game, 'end', 'закончить игру')
 
 
-@bot.group_message_handler(regexp=command_regexp('skip'))
+@bot.group_command_handler('skip')
 def skip_current_stage(message, game, *args, **kwargs):
     create_poll(message, game, 'skip', 'пропустить текущую стадию')
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'poll')
+@bot.callback_handler('poll')
 def poll_vote(call):
     message_id = call.message.message_id
     poll = database.polls.find_one({'message_id': message_id})
@@ -846,16 +877,13 @@ def poll_vote(call):
         )
         return
 
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'players': {'$elemMatch': {
-            'alive': True,
-            'id': call.from_user.id
-        }},
-        'chat': call.message.chat.id
-    })
+    player_game = find_game(
+        {'game': 'mafia', 'chat': call.message.chat.id},
+        ('chat',),
+        matched={'players': {'alive': True, 'id': call.from_user.id}}
+    )
 
-    if not player_game:
+    if not player_game or player_game.matched('players') is None:
         bot.answer_callback_query(
             callback_query_id=call.id,
             show_alert=False,
@@ -869,17 +897,14 @@ def poll_vote(call):
         mafia_count = poll['mafia_count']
         peace_count = poll['peace_count']
 
-        for player in player_game['players']:
-            if player['id'] == call.from_user.id:
-                if player['role'] in ('don', 'mafia'):
-                    increment_value['mafia_count'] = 1
-                    mafia_count += 1
-                else:
-                    increment_value['peace_count'] = 1
-                    peace_count += 1
+        if player_game.matched('players')['role'] in ('don', 'mafia'):
+            increment_value['mafia_count'] = 1
+            mafia_count += 1
+        else:
+            increment_value['peace_count'] = 1
+            peace_count += 1
 
-                poll_condition = mafia_count > poll['mafia_required'] and peace_count >= poll['peace_required']
-                break
+        poll_condition = mafia_count > poll['mafia_required'] and peace_count >= poll['peace_required']
     else:
         increment_value['count'] = 1
         poll_condition = poll['count'] + 1 > poll['required']
@@ -889,11 +914,14 @@ def poll_vote(call):
             chat_id=call.message.chat.id,
             message_id=message_id
         )
+        player_game = games.find_one({'_id': player_game['_id']})
+        if player_game is None:
+            return
         if poll['type'] == 'skip':
             go_to_next_stage(player_game)
         elif poll['type'] == 'end':
-            stop_game(player_game, reason='Игроки проголосовали за окончание игры.')
-            return
+            if stop_game(player_game, reason='Игроки проголосовали за окончание игры.'):
+                return
 
     database.polls.update_one(
         {'_id': poll['_id']},
@@ -910,28 +938,29 @@ def poll_vote(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('shot'))
+@bot.callback_handler('shot')
 def callback_inline(call):
-    player_game = database.games.find_one({
-        'game': 'mafia',
-        'stage': 4,
-        'players': {'$elemMatch': {
-            'alive': True,
-            'role': {'$in': ['don', 'mafia']},
-            'id': call.from_user.id
-        }},
-        'chat': call.message.chat.id
-    })
+    victim = int(call.data.split()[1]) - 1
+    update_result = games.update_one(
+        {
+            'game': 'mafia',
+            'stage': 4,
+            'players': {'$elemMatch': {
+                'alive': True,
+                'role': {'$in': ['don', 'mafia']},
+                'id': call.from_user.id
+            }},
+            'played': {'$ne': call.from_user.id},
+            'chat': call.message.chat.id
+        },
+        {
+            '$addToSet': {'played': call.from_user.id},
+            '$push': {'shots': victim}
+        }
+    )
 
-    if player_game and call.from_user.id not in player_game['played']:
-        victim = int(call.data.split()[1]) - 1
-        database.games.update_one(
-            {'_id': player_game['_id']},
-            {
-                '$addToSet': {'played': call.from_user.id},
-                '$push': {'shots': victim}
-            }
-        )
+    if update_result.matched_count:
+        game_cache.invalidate(call.message.chat.id)
 
         bot.answer_callback_query(
             callback_query_id=call.id,
@@ -947,24 +976,48 @@ def callback_inline(call):
         )
 
 
-@bot.message_handler(
-    func=lambda message: message.from_user.id == config.ADMIN_ID,
-    regexp=command_regexp('reset')
-)
+@bot.command_handler('reset', func=is_admin)
 def reset(message, *args, **kwargs):
-    database.games.delete_many({})
+    games.delete_many({})
+    game_cache.clear()
+    clear_matchers()
     bot.send_message(message.chat.id, 'База игр сброшена!')
 
 
-@bot.message_handler(
-    func=lambda message: message.from_user.id == config.ADMIN_ID,
-    regexp=command_regexp('database')
-)
+@bot.command_handler('database', func=is_admin)
 def print_database(message, *args, **kwargs):
-    print(list(database.games.find()))
+    print(list(games.find()))
     bot.send_message(message.chat.id, 'Все документы базы данных игр выведены в терминал!')
 
 
+@bot.command_handler('profile', func=is_admin)
+def profile_command(message, *args, **kwargs):
+    arguments = message.text.split()[1:]
+    try:
+        seconds = float(arguments[0]) if arguments else getattr(config, 'PROFILE_DEFAULT_TIME', 30)
+    except ValueError:
+        bot.send_message(message.chat.id, 'Использование: /profile [секунды]')
+        return
+    seconds = min(max(seconds, 1), getattr(config, 'PROFILE_MAX_TIME', 600))
+
+    def report(path, stats):
+        if stats is None:
+            bot.try_to_send_message(message.chat.id, 'За время профилирования ничего не было обработано.')
+            return
+        top = format_top(stats, getattr(config, 'PROFILE_TOP_COUNT', 20))
+        bot.try_to_send_message(
+            message.chat.id,
+            f'Профиль сохранён в {html.escape(path, quote=False)}\n\n'
+            f'<pre>  tottime  cumtime   calls function\n{html.escape(top, quote=False)}</pre>',
+            parse_mode='HTML'
+        )
+
+    if profiler.start(seconds, report):
+        bot.send_message(message.chat.id, f'Профилирую обработку обновлений и таймеров {seconds:g} с.')
+    else:
+        bot.send_message(message.chat.id, 'Профилирование уже идёт.')
+
+
 @bot.group_message_handler(content_types=['text'])
 def game_suggestion(message, game, *args, **kwargs):
     if not game or message.text is None:
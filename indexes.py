@@ -0,0 +1,65 @@
+from .logger import logger
+from .database import database
+
+from pymongo import IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+
+INDEXES = {
+    'games': [
+        IndexModel([('chat', ASCENDING)]),
+        IndexModel([('game', ASCENDING), ('next_stage_time', ASCENDING)]),
+        IndexModel([('game', ASCENDING), ('time', ASCENDING)]),
+        IndexModel([('players.id', ASCENDING)]),
+    ],
+    'polls': [
+        IndexModel([('message_id', ASCENDING)]),
+        IndexModel([('chat', ASCENDING)]),
+    ],
+    'requests': [
+        IndexModel([('message_id', ASCENDING)]),
+        IndexModel([('owner.id', ASCENDING), ('chat', ASCENDING)]),
+        IndexModel([('chat', ASCENDING)]),
+        IndexModel([('time', ASCENDING)]),
+    ],
+    'stats': [
+        IndexModel([('id', ASCENDING), ('chat', ASCENDING)]),
+        IndexModel([('chat', ASCENDING), ('mafia_score', DESCENDING), ('_id', ASCENDING)]),
+        IndexModel([('chat', ASCENDING), ('croco_score', DESCENDING), ('_id', ASCENDING)]),
+    ],
+}
+
+
+def ensure_indexes():
+    for collection, indexes in INDEXES.items():
+        existing = database[collection].index_information()
+        missing = [index for index in indexes if index.document['name'] not in existing]
+        for index in missing:
+            logger.info('Создаю индекс %s.%s', collection, index.document['name'])
+        if missing:
+            database[collection].create_indexes(missing)
+
+
+def report_indexes():
+    """Log declared indexes that are missing and indexes that were never used since the server started."""
+    for collection, indexes in INDEXES.items():
+        declared = {index.document['name'] for index in indexes}
+        existing = database[collection].index_information()
+        for name in declared - existing.keys():
+            logger.warning('Отсутствует индекс %s.%s', collection, name)
+
+        try:
+            usage = list(database[collection].aggregate([{'$indexStats': {}}]))
+        except OperationFailure as error:
+            # $indexStats needs the indexStats privilege, which restricted users do not have
+            logger.warning('Не удалось получить статистику индексов %s: %s', collection, error)
+            continue
+        for index_stats in usage:
+            name = index_stats['name']
+            if name == '_id_' or index_stats['accesses']['ops'] > 0:
+                continue
+            since = index_stats['accesses']['since']
+            if name in declared:
+                logger.info('Индекс %s.%s не использовался с %s', collection, name, since)
+            else:
+                logger.warning('Необъявленный индекс %s.%s не использовался с %s', collection, name, since)
@@ -0,0 +1,107 @@
+import config
+from .logger import logger
+from .database import database
+
+import os
+import socket
+import atexit
+from time import time, sleep
+from uuid import uuid4
+from threading import Event
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+
+class LeaderLease:
+    """Lease in the `leases` collection electing the instance that runs the timer loops.
+
+    The leader renews the lease every `heartbeat` seconds. Another instance
+    takes it over once it has not been renewed for `ttl` seconds. The leader
+    considers itself deposed `margin` seconds before its lease expires, so
+    that two instances do not lead at once unless their clocks drift apart
+    by more than that. When disabled, this instance is always the leader.
+
+    Other instances only write deadlines to the database, so the leader
+    reloads the ones due soon every `resync_interval` seconds. `term` counts
+    the times this instance became the leader, so that loops can tell a lost
+    and regained lease from an uninterrupted one.
+    """
+
+    def __init__(self, name, enabled, ttl, heartbeat, margin, resync_interval):
+        self.name = name
+        self.enabled = enabled
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.margin = margin
+        self.resync_interval = resync_interval
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}'
+        self._valid_until = float('inf') if not enabled else 0
+        self.term = 0
+        self._leading = Event()
+        if not enabled:
+            self._leading.set()
+
+    @property
+    def is_leader(self):
+        return time() < self._valid_until
+
+    def wait(self):
+        """Block until this instance is the leader and return the current term."""
+        while not self.is_leader:
+            self._leading.wait(self.heartbeat)
+        return self.term
+
+    def holds(self, term):
+        return self.is_leader and self.term == term
+
+    def _renew(self, now):
+        try:
+            lease = database.leases.find_one_and_update(
+                {'_id': self.name, '$or': [{'owner': self.owner}, {'expires': {'$lt': now}}]},
+                {'$set': {'owner': self.owner, 'expires': now + self.ttl}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            return False
+        return lease is not None and lease['owner'] == self.owner
+
+    def run(self):
+        while True:
+            was_leader = self.is_leader
+            now = time()
+            try:
+                renewed = self._renew(now)
+            except PyMongoError:
+                logger.exception('Не удалось продлить аренду лидера')
+            else:
+                self._valid_until = now + self.ttl - self.margin if renewed else 0
+
+            if self.is_leader:
+                if not was_leader:
+                    self.term += 1
+                    logger.info('Экземпляр %s стал лидером', self.owner)
+                self._leading.set()
+            else:
+                if was_leader:
+                    logger.warning('Экземпляр %s больше не лидер', self.owner)
+                self._leading.clear()
+            sleep(self.heartbeat)
+
+    def release(self):
+        if not self.enabled or not self.is_leader:
+            return
+        self._valid_until = 0
+        self._leading.clear()
+        database.leases.delete_one({'_id': self.name, 'owner': self.owner})
+
+
+leader_lease = LeaderLease(
+    'timers',
+    enabled=getattr(config, 'LEADER_LEASE', False),
+    ttl=getattr(config, 'LEADER_LEASE_TTL', 10),
+    heartbeat=getattr(config, 'LEADER_LEASE_HEARTBEAT', 2),
+    margin=getattr(config, 'LEADER_LEASE_MARGIN', 2),
+    resync_interval=getattr(config, 'LEADER_RESYNC_INTERVAL', 1)
+)
+atexit.register(leader_lease.release)
@@ -0,0 +1,130 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods the bot uses, keeps the messages it sent per chat so that
+simulated users can find inline keyboards to press, and counts calls. Unless
+`strict`, edits of unknown messages succeed, as needed when replaying updates
+that refer to messages sent before the recording.
+"""
+
+import json
+import threading
+from time import time, sleep
+from collections import Counter
+from urllib.parse import urlparse, parse_qsl
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class FakeTelegram:
+    def __init__(self, bot_id=100, username='mafia_host_bot', latency=0, strict=True):
+        self.bot_id = bot_id
+        self.username = username
+        self.latency = latency
+        self.strict = strict
+        self.calls = Counter()
+        self.messages = {}
+        self.answers = {}
+        self._next_message_id = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def api_url(self):
+        host, port = self._server.server_address
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self, host='127.0.0.1', port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('content-length') or 0)
+                if length and self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+                    params.update(parse_qsl(self.rfile.read(length).decode()))
+                method = url.path.rsplit('/', 1)[-1]
+                status, body = fake.call(method, params)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('content-type', 'application/json')
+                self.send_header('content-length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(name='Fake Telegram', target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+
+    def _message(self, chat_id, message_id, text, reply_markup=None):
+        message = {
+            'message_id': message_id,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'},
+            'from': {'id': self.bot_id, 'is_bot': True, 'first_name': 'Mafia Host', 'username': self.username},
+            'text': text
+        }
+        if reply_markup:
+            message['reply_markup'] = reply_markup
+        return message
+
+    def call(self, method, params):
+        if self.latency:
+            sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            if method == 'getMe':
+                result = {'id': self.bot_id, 'is_bot': True, 'first_name': 'Mafia Host', 'username': self.username}
+            elif method == 'sendMessage':
+                chat_id = int(params['chat_id'])
+                self._next_message_id[chat_id] += 1
+                reply_markup = json.loads(params['reply_markup']) if 'reply_markup' in params else None
+                result = self._message(chat_id, self._next_message_id[chat_id], params.get('text', ''), reply_markup)
+                self.messages.setdefault(chat_id, {})[result['message_id']] = result
+            elif method in ('editMessageText', 'editMessageReplyMarkup'):
+                chat_id = int(params['chat_id'])
+                message = self.messages.get(chat_id, {}).get(int(params['message_id']))
+                if message is None and not self.strict:
+                    message = self._message(chat_id, int(params['message_id']), '')
+                    self.messages.setdefault(chat_id, {})[message['message_id']] = message
+                if message is None:
+                    return 400, {'ok': False, 'error_code': 400, 'description': 'Bad Request: message to edit not found'}
+                if method == 'editMessageText':
+                    message['text'] = params.get('text', '')
+                if 'reply_markup' in params:
+                    message['reply_markup'] = json.loads(params['reply_markup'])
+                else:
+                    message.pop('reply_markup', None)
+                result = message
+            elif method == 'deleteMessage':
+                self.messages.get(int(params['chat_id']), {}).pop(int(params['message_id']), None)
+                result = True
+            elif method == 'answerCallbackQuery':
+                self.answers[params['callback_query_id']] = params.get('text', '')
+                result = True
+            else:
+                result = True
+        return 200, {'ok': True, 'result': result}
+
+    def last_message(self, chat_id, predicate=lambda message: True):
+        with self._lock:
+            for message in reversed(list(self.messages.get(chat_id, {}).values())):
+                if predicate(message):
+                    return dict(message)
+        return None
+
+    def buttons(self, message):
+        keyboard = message.get('reply_markup', {}).get('inline_keyboard', [])
+        return [button['callback_data'] for row in keyboard for button in row if 'callback_data' in button]
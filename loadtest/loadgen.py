@@ -0,0 +1,439 @@
+"""End-to-end load generator.
+
+Starts the bot against a local stand-in for the Telegram Bot API and a local
+mongod (--mongo) or mongomock, serves the webhook of `run_app` on localhost
+and lets K simulated chats play mafia, croco and gallows through it.
+
+    python loadtest/loadgen.py --chats 50 --duration 120 --output report.json
+
+Reports update throughput, handler latency, stage-transition lateness and
+database operations per update.
+
+mongomock does not implement the aggregation operators of the pipeline
+updates used for drawing cards and voting, so without --mongo games are kept
+in the in-memory engine, which evaluates them itself, and mongomock only
+receives its journal. Such a run does not measure the default deployment,
+which keeps the games in MongoDB: a warning is printed and the `mode` of the
+report records the database and whether the engine was used. Pass --engine
+to use the engine with a mongod as well.
+"""
+
+import os
+import sys
+import json
+import types
+import random
+import argparse
+import tempfile
+import importlib
+import threading
+import statistics
+from time import time, sleep, perf_counter
+from itertools import count
+from collections import Counter
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_telegram import FakeTelegram  # noqa: E402
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN = '0:loadtest'
+LETTERS = 'абвгдежзийклмнопрстуфхцчшщъыьэюя'
+CHATTER = ['привет', 'кто ведущий?', 'я мирный', 'это точно он', 'ну и ну', 'стреляйте в третьего', 'ладно']
+MONGO_METHODS = (
+    'find', 'find_one', 'insert_one', 'update_one', 'update_many', 'delete_one', 'delete_many',
+    'find_one_and_update', 'find_one_and_delete', 'find_and_modify', 'bulk_write', 'aggregate'
+)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class DatabaseCounter:
+    def __init__(self):
+        self.operations = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.operations += 1
+
+    def install(self, mongo_uri):
+        if mongo_uri:
+            from pymongo import monitoring
+
+            counter = self
+
+            class Listener(monitoring.CommandListener):
+                def started(self, event):
+                    if event.command_name not in ('isMaster', 'ismaster', 'hello', 'endSessions'):
+                        counter.add()
+
+                def succeeded(self, event):
+                    pass
+
+                def failed(self, event):
+                    pass
+
+            monitoring.register(Listener())
+        else:
+            import pymongo
+            import mongomock
+
+            pymongo.MongoClient = mongomock.MongoClient
+            for name in MONGO_METHODS:
+                method = getattr(mongomock.collection.Collection, name)
+
+                def counted(*args, __method=method, **kwargs):
+                    self.add()
+                    return __method(*args, **kwargs)
+
+                setattr(mongomock.collection.Collection, name, counted)
+
+
+def load_package(args, word_base):
+    config = types.ModuleType('config')
+    config.TOKEN = TOKEN
+    config.SKIP_PENDING = False
+    config.SET_WEBHOOK = True
+    config.LOGGER_LEVEL = 'WARNING'
+    config.WORD_BASE = word_base
+    config.DELETE_FROM_EVERYONE = False
+    config.PLAYERS_COUNT_LIMIT = 20
+    config.PLAYERS_COUNT_TO_START = 4
+    config.REQUEST_OVERDUE_TIME = 600
+    config.ADMIN_ID = 0
+    config.WORKERS_COUNT = args.workers
+    config.MONGO_URI = args.mongo
+    config.RECORD_UPDATES = getattr(args, 'record', None)
+    config.GAME_ENGINE = getattr(args, 'engine', False) or not args.mongo
+    if not args.telegram_limits:
+        config.TELEGRAM_GLOBAL_RATE = config.TELEGRAM_GROUP_RATE = config.TELEGRAM_PRIVATE_RATE = (1e9, 1e9)
+    sys.modules['config'] = config
+
+    sys.path.insert(0, os.path.dirname(ROOT))
+    return importlib.import_module(os.path.basename(ROOT))
+
+
+def start_engine(package):
+    engine = package.engine.engine
+    if engine is not None:
+        engine.recover()
+        package.app.start_thread('Game Journal', engine.run)
+
+
+def run_mode(args, package):
+    return {
+        'database': 'mongod' if args.mongo else 'mongomock',
+        'game_engine': package.engine.engine is not None
+    }
+
+
+def warn_mode(args):
+    if not args.mongo:
+        sys.stderr.write(
+            'Warning: without --mongo the games are kept in the in-memory engine, so this run does not measure '
+            'the default deployment, which keeps them in MongoDB. Pass --mongo for representative numbers.\n'
+        )
+
+
+def scale_stage_times(package, scale):
+    for stage in package.stages.stages.values():
+        stage_time = stage['time']
+        if callable(stage_time):
+            stage['time'] = lambda game, stage_time=stage_time: stage_time(game) * scale
+        elif stage_time is not None:
+            stage['time'] = stage_time * scale
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeTelegram(latency=args.api_latency / 1000).start()
+        self.database_counter = DatabaseCounter()
+        self.database_counter.install(args.mongo)
+
+        self._directory = tempfile.TemporaryDirectory()
+        word_base = os.path.join(self._directory.name, 'words.txt')
+        with open(word_base, 'wb') as base:
+            for _ in range(10000):
+                word = ''.join(random.choice(LETTERS) for _ in range(random.randint(4, 9)))
+                base.write((word + '\r\n').encode('cp1251'))
+
+        self.package = load_package(args, word_base)
+        self.update_ids = count(1)
+        self.sent = Counter()
+        self.processed = 0
+        self.latencies = []
+        self.lateness = []
+        self.games = Counter()
+        self._lock = threading.Lock()
+
+    def instrument(self):
+        from telebot import apihelper
+
+        apihelper.API_URL = self.fake.api_url
+        package = self.package
+
+        scale_stage_times(package, self.args.stage_time_scale)
+
+        process = package.workers.workers.process
+
+        def timed_process(updates):
+            started = perf_counter()
+            try:
+                process(updates)
+            finally:
+                with self._lock:
+                    self.processed += len(updates)
+                    self.latencies.append(perf_counter() - started)
+
+        package.workers.workers.process = timed_process
+
+        scheduler = package.scheduler.scheduler
+        wait = scheduler.wait
+
+        def measured_wait(timeout=None):
+            due = wait(timeout)
+            if due:
+                with self._lock:
+                    self.lateness.append(scheduler.lateness)
+            return due
+
+        scheduler.wait = measured_wait
+
+    def start_bot(self):
+        from werkzeug.serving import make_server
+
+        package = self.package
+        package.bot.bot.refresh_identity()
+        package.indexes.ensure_indexes()
+        start_engine(package)
+        package.app.start_thread('Stage Cycle', package.app.stage_cycle)
+        package.app.start_thread('Timers', package.app.timer_cycle)
+        package.workers.workers.start()
+
+        self.server = make_server('127.0.0.1', 0, package.app.create_app(), threaded=True)
+        threading.Thread(name='Webhook', target=self.server.serve_forever, daemon=True).start()
+        self.webhook_url = f'http://127.0.0.1:{self.server.server_port}/{TOKEN}'
+
+    def post(self, session, update):
+        update['update_id'] = next(self.update_ids)
+        response = session.post(self.webhook_url, data=json.dumps(update), headers={'content-type': 'application/json'})
+        with self._lock:
+            self.sent[response.status_code] += 1
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'Player{user_id}', 'username': f'player{user_id}'}
+
+    def send_text(self, session, chat_id, user_id, text):
+        self.post(session, {'message': {
+            'message_id': next(self.update_ids) + 1000000,
+            'date': int(time()),
+            'chat': {'id': chat_id, 'type': 'supergroup'},
+            'from': self.user(user_id),
+            'text': text
+        }})
+
+    def click(self, session, message, user_id, data):
+        callback_id = f'{user_id}:{next(self.update_ids)}'
+        self.post(session, {'callback_query': {
+            'id': callback_id,
+            'chat_instance': str(message['chat']['id']),
+            'from': self.user(user_id),
+            'message': {key: message[key] for key in ('message_id', 'date', 'chat', 'from', 'text')},
+            'data': data
+        }})
+        return callback_id
+
+    def pause(self):
+        sleep(random.expovariate(1 / self.args.click_delay) if self.args.click_delay else 0)
+
+    def finished(self, chat_id, since, markers=('Игра окончена',)):
+        return self.fake.last_message(
+            chat_id,
+            lambda m: m['message_id'] > since and any(marker in m['text'] for marker in markers)
+        ) is not None
+
+    def wait_for(self, chat_id, predicate, timeout=10):
+        deadline = time() + timeout
+        while time() < deadline:
+            message = self.fake.last_message(chat_id, predicate)
+            if message is not None:
+                return message
+            sleep(0.05)
+        return None
+
+    def last_id(self, chat_id):
+        message = self.fake.last_message(chat_id)
+        return message['message_id'] if message else 0
+
+    def play_mafia(self, session, chat_id, users, deadline):
+        since = self.last_id(chat_id)
+        owner = users[0]
+        self.send_text(session, chat_id, owner, '/create')
+        lobby = self.wait_for(chat_id, lambda m: m['message_id'] > since and 'request interact' in self.fake.buttons(m))
+        if lobby is None:
+            return False
+        for user_id in users[1:]:
+            self.click(session, lobby, user_id, 'request interact')
+            self.pause()
+        sleep(self.args.edit_settle)
+        self.send_text(session, chat_id, owner, '/start')
+
+        game_deadline = min(deadline, time() + self.args.game_timeout)
+        ended = False
+        while time() < game_deadline:
+            if self.finished(chat_id, since):
+                return True
+            message = self.fake.last_message(
+                chat_id, lambda m: m['message_id'] > lobby['message_id'] and self.fake.buttons(m)
+            )
+            for user_id in random.sample(users, len(users)):
+                if message is not None:
+                    self.click(session, message, user_id, random.choice(self.fake.buttons(message)))
+                if random.random() < self.args.chatter:
+                    self.send_text(session, chat_id, user_id, random.choice(CHATTER))
+                self.pause()
+            if not ended and time() + 1 > game_deadline:
+                ended = True
+                self.send_text(session, chat_id, owner, '/end')
+        return self.finished(chat_id, since)
+
+    def play_croco(self, session, chat_id, users, deadline):
+        since = self.last_id(chat_id)
+        leader = random.choice(users)
+        self.send_text(session, chat_id, leader, '/croco')
+        message = self.wait_for(chat_id, lambda m: m['message_id'] > since and any(
+            b.startswith('get_word') for b in self.fake.buttons(m)
+        ))
+        if message is None:
+            return False
+        callback_id = self.click(session, message, leader, self.fake.buttons(message)[0])
+        word = None
+        for _ in range(100):
+            answer = self.fake.answers.get(callback_id)
+            if answer:
+                word = answer.split(': ', 1)[1].rstrip('.')
+                break
+            sleep(0.05)
+
+        guesses = random.randint(3, 30)
+        while time() < deadline and not self.finished(chat_id, since):
+            user_id = random.choice([u for u in users if u != leader] or users)
+            guesses -= 1
+            text = word if guesses <= 0 and word else random.choice(CHATTER)
+            self.send_text(session, chat_id, user_id, text)
+            self.pause()
+        return self.finished(chat_id, since)
+
+    def play_gallows(self, session, chat_id, users, deadline):
+        since = self.last_id(chat_id)
+        self.send_text(session, chat_id, users[0], '/gallows')
+        if self.wait_for(chat_id, lambda m: m['message_id'] > since and 'Слово:' in m['text']) is None:
+            return False
+        letters = random.sample(LETTERS, len(LETTERS))
+        markers = ('Вы победили', 'Вы проиграли')
+        while letters and time() < deadline and not self.finished(chat_id, since, markers):
+            self.send_text(session, chat_id, random.choice(users), letters.pop())
+            self.pause()
+        return self.finished(chat_id, since, markers)
+
+    def run_chat(self, index, deadline):
+        session = requests.Session()
+        chat_id = -1000000 - index
+        users = [index * 1000 + i for i in range(1, self.args.players + 1)]
+        games = self.args.games.split(',')
+        for round_number in count(index):
+            if time() >= deadline:
+                break
+            game = games[round_number % len(games)]
+            if getattr(self, f'play_{game}')(session, chat_id, users, deadline):
+                with self._lock:
+                    self.games[game] += 1
+            sleep(self.args.edit_settle)
+
+    def run(self):
+        self.instrument()
+        self.start_bot()
+
+        started = time()
+        deadline = started + self.args.duration
+        threads = [
+            threading.Thread(name=f'Chat {i}', target=self.run_chat, args=(i, deadline), daemon=True)
+            for i in range(self.args.chats)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - started
+
+        latencies = [latency * 1000 for latency in self.latencies]
+        lateness = [delay * 1000 for delay in self.lateness]
+        return {
+            'parameters': vars(self.args),
+            'mode': run_mode(self.args, self.package),
+            'duration': elapsed,
+            'updates_sent': sum(self.sent.values()),
+            'responses': dict(self.sent),
+            'updates_processed': self.processed,
+            'updates_per_second': self.processed / elapsed,
+            'handler_latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies, default=None),
+                'mean': statistics.mean(latencies) if latencies else None
+            },
+            'stage_lateness_ms': {
+                'p50': percentile(lateness, 0.5),
+                'p99': percentile(lateness, 0.99),
+                'max': max(lateness, default=None),
+                'transitions': len(lateness)
+            },
+            'database_operations': self.database_counter.operations,
+            'database_operations_per_update': self.database_counter.operations / max(1, self.processed),
+            'api_calls': dict(self.fake.calls),
+            'games_finished': dict(self.games)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chats', type=int, default=10, help='number of concurrent chats')
+    parser.add_argument('--players', type=int, default=6, help='users per chat')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to generate load for')
+    parser.add_argument('--games', default='mafia,croco,gallows', help='comma separated games the chats play in turn')
+    parser.add_argument('--click-delay', type=float, default=0.2, help='mean pause between actions of a chat in seconds')
+    parser.add_argument('--chatter', type=float, default=0.3, help='probability of a chat message per player per round')
+    parser.add_argument('--stage-time-scale', type=float, default=0.05, help='multiplier for mafia stage durations')
+    parser.add_argument('--game-timeout', type=float, default=60, help='seconds after which a mafia game is ended by poll')
+    parser.add_argument('--edit-settle', type=float, default=0.6, help='pause letting coalesced edits reach the API')
+    parser.add_argument('--api-latency', type=float, default=0, help='latency of the fake Telegram API in ms')
+    parser.add_argument('--telegram-limits', action='store_true', help='keep the Telegram flood limits of the sender')
+    parser.add_argument('--workers', type=int, default=16, help='number of update workers')
+    parser.add_argument('--mongo', help='URI of a local mongod, mongomock is used if omitted')
+    parser.add_argument('--engine', action='store_true', help='keep games in memory with the write-behind journal (always without --mongo)')
+    parser.add_argument('--record', help='directory to record the generated webhook traffic to')
+    parser.add_argument('--output', help='file to write the JSON report to (stdout by default)')
+    args = parser.parse_args()
+    warn_mode(args)
+
+    report = LoadTest(args).run()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
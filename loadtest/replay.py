@@ -0,0 +1,198 @@
+"""Replay of recorded webhook traffic.
+
+Feeds updates written by the recorder (RECORD_UPDATES) through the update
+workers, and so through `bot.process_new_updates`, against the local stand-in
+for the Telegram Bot API, preserving the recorded gaps between arrivals:
+
+    python loadtest/replay.py recordings/ --speed 4 --username mafia_host_bot
+    python loadtest/replay.py updates-20201016-*.jsonl.gz --speed max
+
+Reports how far the replay slipped behind the recorded schedule together with
+handler latency, stage lateness and database operations per update.
+"""
+
+import os
+import sys
+import json
+import glob
+import importlib
+import argparse
+import threading
+import statistics
+from time import sleep, perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_telegram import FakeTelegram  # noqa: E402
+from loadgen import DatabaseCounter, load_package, scale_stage_times, start_engine, percentile, run_mode, warn_mode  # noqa: E402
+
+
+def recording_paths(paths):
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(glob.glob(os.path.join(path, 'updates-*.jsonl.gz'))))
+        else:
+            result.extend(sorted(glob.glob(path)))
+    return result
+
+
+class Replay:
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeTelegram(username=args.username, latency=args.api_latency / 1000, strict=False).start()
+        self.database_counter = DatabaseCounter()
+        self.database_counter.install(args.mongo)
+        self.package = load_package(args, args.word_base)
+        self.latencies = []
+        self.lateness = []
+        self.processed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._done = threading.Condition(self._lock)
+
+    def instrument(self):
+        from telebot import apihelper
+
+        apihelper.API_URL = self.fake.api_url
+        package = self.package
+        if self.args.speed:
+            scale_stage_times(package, 1 / self.args.speed)
+
+        process = package.workers.workers.process
+
+        def timed_process(updates):
+            started = perf_counter()
+            try:
+                process(updates)
+            finally:
+                with self._lock:
+                    self.processed += len(updates)
+                    self.latencies.append(perf_counter() - started)
+                    self._done.notify_all()
+
+        package.workers.workers.process = timed_process
+
+        scheduler = package.scheduler.scheduler
+        wait = scheduler.wait
+
+        def measured_wait(timeout=None):
+            due = wait(timeout)
+            if due:
+                with self._lock:
+                    self.lateness.append(scheduler.lateness)
+            return due
+
+        scheduler.wait = measured_wait
+
+    def start_bot(self):
+        package = self.package
+        package.bot.bot.refresh_identity()
+        package.indexes.ensure_indexes()
+        start_engine(package)
+        package.app.start_thread('Stage Cycle', package.app.stage_cycle)
+        package.app.start_thread('Timers', package.app.timer_cycle)
+        package.workers.workers.start()
+
+    def run(self):
+        from telebot.types import Update
+
+        read_recording = importlib.import_module(self.package.__name__ + '.recorder').read_recording
+        self.instrument()
+        self.start_bot()
+
+        speed = self.args.speed
+        slips = []
+        fed = 0
+        first_arrival = last_arrival = None
+        started = perf_counter()
+        for path in recording_paths(self.args.recordings):
+            for arrival, update in read_recording(path):
+                if first_arrival is None:
+                    first_arrival = arrival
+                last_arrival = arrival
+                if speed:
+                    due = started + (arrival - first_arrival) / speed
+                    delay = due - perf_counter()
+                    if delay > 0:
+                        sleep(delay)
+                    slips.append(max(0, -delay))
+                update = Update.de_json(json.dumps(update))
+                while not self.package.workers.workers.put(update):
+                    if speed:
+                        with self._lock:
+                            self.rejected += 1
+                        break
+                    sleep(0.001)
+                else:
+                    fed += 1
+
+        with self._lock:
+            self._done.wait_for(lambda: self.processed >= fed, timeout=self.args.drain_timeout)
+        elapsed = perf_counter() - started
+
+        latencies = [latency * 1000 for latency in self.latencies]
+        lateness = [delay * 1000 for delay in self.lateness]
+        slips = [slip * 1000 for slip in slips]
+        return {
+            'parameters': vars(self.args),
+            'mode': run_mode(self.args, self.package),
+            'duration': elapsed,
+            'recorded_duration': last_arrival - first_arrival if first_arrival is not None else 0,
+            'updates_fed': fed,
+            'updates_rejected': self.rejected,
+            'updates_processed': self.processed,
+            'updates_per_second': self.processed / elapsed,
+            'schedule_slip_ms': {
+                'p50': percentile(slips, 0.5),
+                'p99': percentile(slips, 0.99),
+                'max': max(slips, default=None)
+            },
+            'handler_latency_ms': {
+                'p50': percentile(latencies, 0.5),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies, default=None),
+                'mean': statistics.mean(latencies) if latencies else None
+            },
+            'stage_lateness_ms': {
+                'p50': percentile(lateness, 0.5),
+                'p99': percentile(lateness, 0.99),
+                'max': max(lateness, default=None),
+                'transitions': len(lateness)
+            },
+            'database_operations': self.database_counter.operations,
+            'database_operations_per_update': self.database_counter.operations / max(1, self.processed),
+            'api_calls': dict(self.fake.calls)
+        }
+
+
+def speed(value):
+    return 0 if value == 'max' else float(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recordings', nargs='+', help='recording files, globs or directories')
+    parser.add_argument('--speed', type=speed, default=1, help='replay speed multiplier or "max" to ignore arrival times')
+    parser.add_argument('--username', default='mafia_host_bot', help='bot username the recorded commands address')
+    parser.add_argument('--word-base', required=True, help='croco word base to use')
+    parser.add_argument('--api-latency', type=float, default=0, help='latency of the fake Telegram API in ms')
+    parser.add_argument('--telegram-limits', action='store_true', help='keep the Telegram flood limits of the sender')
+    parser.add_argument('--workers', type=int, default=16, help='number of update workers')
+    parser.add_argument('--mongo', help='URI of a local mongod, mongomock is used if omitted')
+    parser.add_argument('--engine', action='store_true', help='keep games in memory with the write-behind journal (always without --mongo)')
+    parser.add_argument('--drain-timeout', type=float, default=60, help='seconds to wait for queued updates at the end')
+    parser.add_argument('--output', help='file to write the JSON report to (stdout by default)')
+    args = parser.parse_args()
+    warn_mode(args)
+
+    report = Replay(args).run()
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
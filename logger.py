@@ -1,6 +1,13 @@
-
+import config
 from config import LOGGER_LEVEL
+
+import re
+import json
+import atexit
+import random
 import logging
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
 
 
 class c:
@@ -9,22 +16,73 @@ class c:
     e = '\033[0m'
 
 
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the fields passed in `extra={'fields': ...}`."""
+
+    color = re.compile('\033\\[[0-9;]*m')
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'thread': record.threadName,
+            'message': self.color.sub('', record.getMessage())
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler passing records unchanged, so that messages are formatted on the listener thread."""
+
+    def prepare(self, record):
+        return record
+
+
 def configure_logger():
     logger = logging.getLogger("mafbot")
     logger.setLevel(LOGGER_LEVEL)
     terminal_logger = logging.StreamHandler()
-    formatter = logging.Formatter(f"\r{c.g}[%(asctime)s.%(msecs).03d]{c.e} %(message)s", datefmt="%H:%M:%S")
+    if getattr(config, 'LOGGER_FORMAT', 'text') == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(f"\r{c.g}[%(asctime)s.%(msecs).03d]{c.e} %(message)s", datefmt="%H:%M:%S")
     terminal_logger.setFormatter(formatter)
-    logger.addHandler(terminal_logger)
+
+    queue = SimpleQueue()
+    listener = QueueListener(queue, terminal_logger)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(LazyQueueHandler(queue))
     logger.propagate = False
     return logger
 
 
+class Escaped:
+    """Text shown without quotes and with special characters escaped, computed only when formatted."""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return repr(self.text)[1:-1]
+
+
 logging.getLogger('werkzeug').setLevel(logging.ERROR)
 logger = configure_logger()
+update_log_sampling = getattr(config, 'UPDATE_LOG_SAMPLING', 1)
 
 
 def log_update(update):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    if update_log_sampling < 1 and random.random() >= update_log_sampling:
+        return
+
     if update.message:
         chat = update.message.chat.id
         id = update.message.from_user.id
@@ -38,4 +96,7 @@ def log_update(update):
     else:
         return
 
-    logger.info(f'<{chat:>14}:{id:<9}> {qc}{repr(msg)[1:-1]}{c.e}')
+    logger.info(
+        '<%14s:%-9s> %s%s%s', chat, id, qc, Escaped(msg), c.e,
+        extra={'fields': {'chat': chat, 'user': id, 'text': msg}}
+    )
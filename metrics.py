@@ -0,0 +1,178 @@
+from .logger import logger
+
+from threading import Lock
+from contextlib import contextmanager
+from time import perf_counter
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            values = self._snapshot()
+        for labels, value in values:
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _snapshot(self):
+        return list(self._values.items())
+
+    def _render_value(self, labels, value):
+        return [f'{self.name}{_format_labels(self.labels, labels)} {value}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """Gauge either set directly or, with `collect`, computed at scrape time.
+
+    `collect` returns an iterable of `(labels, value)` pairs.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), collect=None):
+        super().__init__(name, documentation, labels)
+        self.collect = collect
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self):
+        if self.collect is not None:
+            try:
+                values = {tuple(labels): value for labels, value in self.collect()}
+            except Exception:
+                logger.exception('Не удалось собрать метрику %s', self.name)
+            else:
+                with self._lock:
+                    self._values = values
+        return super().render()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, *labels)
+
+    def _render_value(self, labels, value):
+        counts, total, count = value
+        names = self.labels + ('le',)
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}')
+        lines.append(f'{self.name}_bucket{_format_labels(names, labels + ("+Inf",))} {count}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {total}')
+        lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {count}')
+        return lines
+
+    def _snapshot(self):
+        return [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+handled_updates = registry.counter(
+    'mafia_updates_total', 'Updates passed to a handler', ('type', 'handler')
+)
+handler_latency = registry.histogram(
+    'mafia_handler_seconds', 'Time spent in update handlers', ('type', 'handler')
+)
+mongo_operations = registry.counter(
+    'mafia_mongo_operations_total', 'MongoDB commands by collection and outcome', ('command', 'collection', 'outcome')
+)
+mongo_latency = registry.histogram(
+    'mafia_mongo_seconds', 'MongoDB command duration', ('command', 'collection')
+)
+telegram_requests = registry.counter(
+    'mafia_telegram_requests_total', 'Telegram Bot API requests', ('method',)
+)
+telegram_errors = registry.counter(
+    'mafia_telegram_errors_total', 'Failed Telegram Bot API requests by status code', ('method', 'status')
+)
+telegram_rate_limited = registry.counter(
+    'mafia_telegram_rate_limited_total', 'Telegram Bot API requests answered with 429', ('method',)
+)
+telegram_latency = registry.histogram(
+    'mafia_telegram_seconds', 'Telegram Bot API request duration', ('method',)
+)
+scheduler_lag = registry.histogram(
+    'mafia_stage_lag_seconds', 'Delay between next_stage_time and the actual stage transition',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+)
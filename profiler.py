@@ -0,0 +1,101 @@
+import config
+from .logger import logger
+
+import os
+import io
+import pstats
+import cProfile
+from time import strftime
+from threading import Lock, Timer, local
+from contextlib import contextmanager
+
+
+class CaptureProfiler:
+    """cProfile capture switched on for a limited time around update processing and timer ticks.
+
+    cProfile only follows the thread that enabled it, so each thread entering
+    `capture` gets its own profile, and all of them are merged when the
+    session ends. Nested captures in one thread are folded into the outer one.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._session = None
+        self._profiles = []
+        self._local = local()
+        self._lock = Lock()
+
+    @property
+    def active(self):
+        return self._session is not None
+
+    def start(self, seconds, callback):
+        """Capture for `seconds` and then call `callback(path, stats)` with the merged pstats.Stats."""
+        with self._lock:
+            if self._session is not None:
+                return False
+            self._session = object()
+            self._profiles = []
+        Timer(seconds, self._finish, args=(callback,)).start()
+        return True
+
+    @contextmanager
+    def capture(self):
+        session = self._session
+        if session is None or getattr(self._local, 'depth', 0):
+            yield
+            return
+
+        if getattr(self._local, 'session', None) is not session:
+            self._local.session = session
+            self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(self._local.profile)
+        profile = self._local.profile
+
+        self._local.depth = 1
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.depth = 0
+
+    def _finish(self, callback):
+        with self._lock:
+            self._session = None
+            profiles, self._profiles = self._profiles, []
+
+        try:
+            stats = None
+            for profile in profiles:
+                profile.create_stats()
+                if stats is None:
+                    stats = pstats.Stats(profile, stream=io.StringIO())
+                else:
+                    stats.add(profile)
+
+            path = None
+            if stats is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f'profile-{strftime("%Y%m%d-%H%M%S")}.prof')
+                stats.dump_stats(path)
+                logger.info('Профиль сохранён в %s', path)
+            callback(path, stats)
+        except Exception:
+            logger.exception('Ошибка при сохранении профиля')
+
+
+def format_top(stats, limit, sort='tottime'):
+    """Short table of the functions with the largest `sort` value."""
+    stats.sort_stats(sort)
+    lines = []
+    for function in stats.fcn_list[:limit]:
+        primitive_calls, calls, total_time, cumulative_time, _ = stats.stats[function]
+        filename, line, name = function
+        location = f'{os.path.basename(filename)}:{line}' if line else filename
+        lines.append(f'{total_time:8.3f} {cumulative_time:8.3f} {calls:>7} {location}({name})')
+    return '\n'.join(lines)
+
+
+profiler = CaptureProfiler(getattr(config, 'PROFILE_DIR', 'profiles'))
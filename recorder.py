@@ -0,0 +1,106 @@
+import config
+from .logger import logger
+
+import os
+import gzip
+import json
+import atexit
+from time import time, strftime
+from queue import Queue, Full, Empty
+from threading import Thread
+
+
+class UpdateRecorder:
+    """Writer of incoming webhook updates with their arrival time to rotating gzipped JSONL files.
+
+    `record` only puts the update as received into an envelope line and
+    queues it, and a background thread compresses and writes the lines, so
+    the webhook does not wait for the disk. Lines arriving while `queue_size`
+    lines wait are dropped. A new file is started once the current one has
+    received `max_bytes` of uncompressed data, and only the `backups` newest
+    files, and at least the current one, are kept.
+    """
+
+    def __init__(self, directory, max_bytes, backups, flush_interval=5, queue_size=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._file = None
+        self._written = 0
+        self._dropped = 0
+        self._queue = Queue(maxsize=queue_size)
+        os.makedirs(directory, exist_ok=True)
+        self._thread = Thread(name='Update Recorder', target=self._write, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, json_string, arrival):
+        # A JSON document has newlines only between tokens, where a space is equivalent
+        line = '{"time": %r, "update": %s}\n' % (arrival, json_string.replace('\r', ' ').replace('\n', ' '))
+        try:
+            self._queue.put_nowait(line)
+        except Full:
+            self._dropped += 1
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _write(self):
+        flushed = time()
+        while True:
+            if self._file is not None and time() - flushed > self.flush_interval:
+                self._file.flush()
+                flushed = time()
+            try:
+                line = self._queue.get(timeout=self.flush_interval)
+            except Empty:
+                continue
+            if line is None:
+                break
+            if self._dropped:
+                dropped, self._dropped = self._dropped, 0
+                logger.warning('Очередь записи обновлений переполнена, пропущено обновлений: %s', dropped)
+            try:
+                if self._file is None or self._written >= self.max_bytes:
+                    self._rotate()
+                self._file.write(line)
+                self._written += len(line)
+            except OSError:
+                logger.exception('Не удалось записать обновление')
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        path = os.path.join(self.directory, f'updates-{strftime("%Y%m%d-%H%M%S")}-{int(time() * 1000) % 1000:03}.jsonl.gz')
+        logger.info('Записываю обновления в %s', path)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._written = 0
+
+        recordings = sorted(name for name in os.listdir(self.directory) if name.startswith('updates-'))
+        for name in recordings[:len(recordings) - max(1, self.backups)]:
+            os.remove(os.path.join(self.directory, name))
+
+
+def read_recording(path):
+    """Yield `(arrival, update)` pairs of a recording, tolerating a file cut off by a crash."""
+    with gzip.open(path, 'rt', encoding='utf-8') as recording:
+        try:
+            for line in recording:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['time'], record['update']
+        except (EOFError, json.JSONDecodeError):
+            logger.warning('Запись %s оборвана', path)
+
+
+recorder = UpdateRecorder(
+    config.RECORD_UPDATES,
+    max_bytes=getattr(config, 'RECORD_MAX_BYTES', 64 * 1024 * 1024),
+    backups=getattr(config, 'RECORD_BACKUPS', 24)
+) if getattr(config, 'RECORD_UPDATES', None) else None
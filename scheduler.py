@@ -0,0 +1,86 @@
+from .lease import leader_lease
+
+import heapq
+from time import time
+from threading import Condition
+
+
+class StageScheduler:
+    """Priority queue of mafia stage deadlines keyed by game id.
+
+    Rescheduling a game pushes a new heap entry and leaves the old one to be
+    dropped lazily when it reaches the top of the heap. Deadlines are only
+    kept while `active()` is true: other instances load them from the
+    database when they take over.
+    """
+
+    def __init__(self, active=lambda: True):
+        self.active = active
+        self._heap = []
+        self._deadlines = {}
+        self._condition = Condition()
+        self.lateness = 0
+        self.max_lateness = 0
+
+    def schedule(self, game_id, deadline):
+        if not self.active():
+            return
+        with self._condition:
+            self._deadlines[game_id] = deadline
+            heapq.heappush(self._heap, (deadline, game_id))
+            if len(self._heap) > 2 * len(self._deadlines) + 64:
+                self._compact()
+            if self._heap[0][1] == game_id:
+                self._condition.notify()
+
+    def cancel(self, game_id):
+        with self._condition:
+            self._deadlines.pop(game_id, None)
+
+    def clear(self):
+        with self._condition:
+            self._heap.clear()
+            self._deadlines.clear()
+
+    def load(self, games):
+        for game in games:
+            self.schedule(game['_id'], game['next_stage_time'])
+
+    def _compact(self):
+        self._heap = [(d, g) for g, d in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+    def wait(self, timeout=None):
+        """Block until the nearest deadline passes and return due (game_id, deadline) pairs.
+
+        Returns an empty list if nothing is due within `timeout` seconds.
+        """
+        end = None if timeout is None else time() + timeout
+        with self._condition:
+            while True:
+                while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+                    heapq.heappop(self._heap)
+
+                now = time()
+                if end is not None and now >= end:
+                    return []
+                delay = self._heap[0][0] - now if self._heap else None
+                if delay is None or delay > 0:
+                    if end is not None:
+                        delay = end - now if delay is None else min(delay, end - now)
+                    self._condition.wait(delay)
+                    continue
+
+                due = []
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, game_id = heapq.heappop(self._heap)
+                    if self._deadlines.get(game_id) == deadline:
+                        del self._deadlines[game_id]
+                        due.append((game_id, deadline))
+
+                self.lateness = now - due[0][1]
+                self.max_lateness = max(self.max_lateness, self.lateness)
+                return due
+
+
+scheduler = StageScheduler(active=lambda: leader_lease.is_leader)
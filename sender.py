@@ -0,0 +1,191 @@
+import config
+from .logger import logger
+from .metrics import telegram_requests, telegram_errors, telegram_rate_limited, telegram_latency
+
+from time import time
+from collections import deque, OrderedDict
+from threading import Condition, Thread
+from concurrent.futures import Future, ThreadPoolExecutor
+from telebot.apihelper import ApiException
+
+
+ANSWER, SEND, EDIT = range(3)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundRequest:
+    __slots__ = ('priority', 'chat', 'call', 'args', 'kwargs', 'future', 'key', 'not_before')
+
+    def __init__(self, priority, chat, call, args, kwargs, key=None, not_before=0):
+        self.priority = priority
+        self.chat = chat
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.key = key
+        self.not_before = not_before
+
+
+class Sender:
+    """Queue of outgoing API requests obeying Telegram's flood limits.
+
+    Requests wait in priority lanes (callback answers first, cosmetic edits
+    last) and leave as soon as both the global bucket and the bucket of their
+    chat have a token. Only one request per chat is in flight at a time, so
+    messages of a chat keep their order. A 429 response blocks the chat, or
+    the whole bot for requests without a chat, for `retry_after` seconds and
+    puts the request back at the head of its lane.
+
+    Coalesced edits wait for a debounce window, and a newer edit of the same
+    message that arrives meanwhile replaces the arguments of the queued one.
+    """
+
+    def __init__(self, global_rate, group_rate, private_rate, threads, debounce):
+        self.debounce = debounce
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self._global = TokenBucket(*global_rate)
+        self._buckets = {}
+        self._blocked = {}
+        self._in_flight = set()
+        self._pending_edits = {}
+        self._lanes = [OrderedDict() for _ in range(EDIT + 1)]
+        self._condition = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='Sender')
+        self._thread = None
+
+    def submit(self, priority, chat, call, *args, **kwargs):
+        return self._enqueue(OutboundRequest(priority, chat, call, args, kwargs))
+
+    def coalesce(self, key, chat, call, *args, **kwargs):
+        with self._condition:
+            request = self._pending_edits.get(key)
+            if request is not None:
+                request.call = call
+                request.args = args
+                request.kwargs = kwargs
+                return request.future
+            request = OutboundRequest(EDIT, chat, call, args, kwargs, key=key, not_before=time() + self.debounce)
+            self._pending_edits[key] = request
+            return self._enqueue(request)
+
+    def _enqueue(self, request):
+        with self._condition:
+            if self._thread is None:
+                self._thread = Thread(name='Sender', target=self._dispatch, daemon=True)
+                self._thread.start()
+            self._lanes[request.priority].setdefault(request.chat, deque()).append(request)
+            self._condition.notify()
+        return request.future
+
+    def _bucket(self, chat):
+        bucket = self._buckets.get(chat)
+        if bucket is None:
+            rate = self.group_rate if chat < 0 else self.private_rate
+            bucket = self._buckets[chat] = TokenBucket(*rate)
+        return bucket
+
+    def _delay(self, chat, now):
+        delay = max(self._global.delay(now), self._blocked.get(chat, 0) - now)
+        if chat is not None:
+            delay = max(delay, self._bucket(chat).delay(now), self._blocked.get(None, 0) - now)
+        return delay
+
+    def _next_request(self, now):
+        wait = None
+        for lane in self._lanes:
+            for chat, requests in lane.items():
+                if chat in self._in_flight:
+                    continue
+                delay = max(self._delay(chat, now), requests[0].not_before - now)
+                if delay <= 0:
+                    request = requests.popleft()
+                    if not requests:
+                        del lane[chat]
+                    if request.key is not None:
+                        del self._pending_edits[request.key]
+                    return request, 0
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                now = time()
+                request, wait = self._next_request(now)
+                if request is None:
+                    self._condition.wait(wait)
+                    continue
+                self._global.take(now)
+                if request.chat is not None:
+                    self._bucket(request.chat).take(now)
+                    self._in_flight.add(request.chat)
+                if len(self._buckets) > 10000:
+                    self._buckets = {c: b for c, b in self._buckets.items() if not b.is_full(now)}
+                    self._blocked = {c: t for c, t in self._blocked.items() if t > now}
+            self._executor.submit(self._execute, request)
+
+    def _execute(self, request):
+        try:
+            self._call(request)
+        finally:
+            with self._condition:
+                self._in_flight.discard(request.chat)
+                self._condition.notify()
+
+    def _call(self, request):
+        method = request.call.__name__
+        telegram_requests.inc(method)
+        try:
+            with telegram_latency.time(method):
+                result = request.call(*request.args, **request.kwargs)
+        except ApiException as exception:
+            telegram_errors.inc(method, str(exception.result.status_code))
+            if exception.result.status_code == 429:
+                telegram_rate_limited.inc(method)
+                retry_after = exception.result.json().get('parameters', {}).get('retry_after', 1)
+                logger.warning('Превышен лимит запросов к API, повтор через %s с', retry_after)
+                with self._condition:
+                    self._blocked[request.chat] = time() + retry_after
+                    self._lanes[request.priority].setdefault(request.chat, deque()).appendleft(request)
+                    self._lanes[request.priority].move_to_end(request.chat, last=False)
+                return
+            request.future.set_exception(exception)
+        except Exception as exception:
+            telegram_errors.inc(method, 'exception')
+            request.future.set_exception(exception)
+        else:
+            request.future.set_result(result)
+
+
+sender = Sender(
+    global_rate=getattr(config, 'TELEGRAM_GLOBAL_RATE', (30, 30)),
+    group_rate=getattr(config, 'TELEGRAM_GROUP_RATE', (20 / 60, 20)),
+    private_rate=getattr(config, 'TELEGRAM_PRIVATE_RATE', (1, 3)),
+    threads=getattr(config, 'SENDER_THREADS', 8),
+    debounce=getattr(config, 'EDIT_DEBOUNCE', 0.5)
+)
@@ -1,7 +1,10 @@
 from . import lang
 from .bot import bot
 from .database import database
-from .game import role_titles
+from .engine import games
+from .game import role_titles, stage_filter
+from .scheduler import scheduler
+from .cache import game_cache
 
 import random
 from time import time
@@ -21,17 +24,25 @@ def add_stage(number, time=None, delete=False):
 
 
 def go_to_next_stage(game, inc=1):
-    database.polls.delete_many({'chat': game['chat']})
+    """Move the game from the stage it is in to the next one.
 
+    The transition only happens if the game is still at `game['stage']` and
+    `game['next_stage_time']`, so of concurrent callers moving the game away
+    from the same stage only one wins. The others get None.
+    """
+    current = stage_filter(game)
     stage_number = 0 if game['stage'] == max(stages.keys()) + 1 - inc else game['stage'] + inc
     stage = stages[stage_number]
     if stage['delete']:
-        database.games.delete_one({'_id': game['_id']})
+        if not games.delete_one(current).deleted_count:
+            return None
+        game_cache.invalidate(game['chat'])
+        scheduler.cancel(game['_id'])
         new_game = game
     else:
         time_inc = stage['time'](game) if callable(stage['time']) else stage['time']
-        new_game = database.games.find_one_and_update(
-            {'_id': game['_id']},
+        new_game = games.find_one_and_update(
+            current,
             {
                 '$set': {
                     'next_stage_time': time() + (time_inc if isinstance(time_inc, (int, float)) else 0),
@@ -41,12 +52,20 @@ def go_to_next_stage(game, inc=1):
                 '$inc': {'day_count': int(stage_number == 0)}},
             return_document=ReturnDocument.AFTER
         )
+        if new_game is None:
+            return None
+        game_cache.invalidate(game['chat'])
+        scheduler.schedule(new_game['_id'], new_game['next_stage_time'])
+
+    database.polls.delete_many({'chat': game['chat']})
 
     try:
         stage['func'](new_game)
     except ApiException as exception:
         if exception.result.status_code == 403:
-            database.games.delete_one({'_id': game['_id']})
+            games.delete_one({'_id': game['_id']})
+            game_cache.invalidate(game['chat'])
+            scheduler.cancel(game['_id'])
             return
 
     return new_game
@@ -101,7 +120,8 @@ def set_order(game):
         reply_markup=keyboard
     ).message_id
 
-    database.games.update_one({'_id': game['_id']}, {'$set': {'message_id': message_id}})
+    games.update_one({'_id': game['_id']}, {'$set': {'message_id': message_id}})
+    game_cache.invalidate(game['chat'])
 
 
 @add_stage(-1, 5)
@@ -139,7 +159,8 @@ def discussion(game):
         )
     else:
         if game['day_count'] > 1:
-            database.games.update_one({'_id': game['_id']}, {'$unset': {'victim': True}})
+            games.update_one({'_id': game['_id']}, {'$unset': {'victim': True}})
+            game_cache.invalidate(game['chat'])
         bot.send_message(
             game['chat'],
             lang.morning_message.format(
@@ -182,7 +203,8 @@ def vote(game):
         reply_markup=keyboard
     ).message_id
 
-    database.games.update_one({'_id': game['_id']}, {'$set': {'message_id': message_id}})
+    games.update_one({'_id': game['_id']}, {'$set': {'message_id': message_id}})
+    game_cache.invalidate(game['chat'])
 
 
 @add_stage(2, 20)
@@ -207,7 +229,8 @@ def last_words_criminal(game):
         update_dict['$set'][f'players.{criminal}.alive'] = False
         update_dict['$set']['victim'] = game['players'][criminal]['id']
 
-    database.games.update_one({'_id': game['_id']}, update_dict)
+    games.update_one({'_id': game['_id']}, update_dict)
+    game_cache.invalidate(game['chat'])
 
 
 @add_stage(3, 5)
@@ -216,13 +239,14 @@ def night(game):
         game['chat'],
         f'Наступает ночь. Город засыпает. {role_titles["mafia"].capitalize()}, приготовьтесь к выстрелу...'
     ).message_id
-    database.games.update_one(
+    games.update_one(
         {'_id': game['_id']},
         {
             '$unset': {'victim': True},
             '$set': {'message_id': message_id}
         }
     )
+    game_cache.invalidate(game['chat'])
 
 
 @add_stage(4, 5)
@@ -294,7 +318,8 @@ def last_words_victim(game):
             update_dict['$set'][f'players.{victim}.alive'] = False
             update_dict['$set']['victim'] = game['players'][victim]['id']
 
-    database.games.update_one({'_id': game['_id']}, update_dict)
+    games.update_one({'_id': game['_id']}, update_dict)
+    game_cache.invalidate(game['chat'])
 
     if not mafia_shot:
         go_to_next_stage(game)
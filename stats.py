@@ -0,0 +1,66 @@
+from .database import database
+
+from pymongo import UpdateOne
+
+
+def get_score_increments(increments):
+    """Leaderboard score changes implied by stats increments.
+
+    `mafia_score` follows `handlers.get_mafia_score` and `croco_score` keeps
+    the croco score multiplied by 25, so that both stay integers.
+    """
+    result = {}
+    if 'total' in increments or 'win' in increments:
+        result['mafia_score'] = 2 * increments.get('win', 0) - increments.get('total', 0)
+    if any(key in increments for key in ('croco.total', 'croco.win', 'croco.guesses', 'croco.cheat')):
+        result['croco_score'] = (
+            3 * increments.get('croco.win', 0) +
+            increments.get('croco.guesses', 0) -
+            increments.get('croco.cheat', 0)
+        )
+    return result
+
+
+def ensure_leaderboards():
+    database.stats.update_many(
+        {'total': {'$exists': True}, 'mafia_score': {'$exists': False}},
+        [{'$set': {'mafia_score': {'$subtract': [{'$multiply': [2, {'$ifNull': ['$win', 0]}]}, '$total']}}}]
+    )
+    database.stats.update_many(
+        {'croco': {'$exists': True}, 'croco_score': {'$exists': False}},
+        [{'$set': {'croco_score': {'$subtract': [
+            {'$add': [{'$multiply': [3, {'$ifNull': ['$croco.win', 0]}]}, {'$ifNull': ['$croco.guesses', 0]}]},
+            {'$ifNull': ['$croco.cheat', 0]}
+        ]}}}]
+    )
+
+
+def get_leaderboard(chat, score, limit):
+    return database.stats.find(
+        {'chat': chat, score: {'$exists': True}},
+        {'name': True, score: True}
+    ).sort([(score, -1), ('_id', 1)]).limit(limit)
+
+
+class StatsBatch:
+    """Stats increments collected at the end of a game and written with one bulk_write."""
+
+    def __init__(self):
+        self._updates = {}
+
+    def add(self, chat, user_id, increments, name=None):
+        update = self._updates.setdefault((chat, user_id), {'$inc': {}})
+        for key, value in {**increments, **get_score_increments(increments)}.items():
+            update['$inc'][key] = update['$inc'].get(key, 0) + value
+        if name is not None:
+            update['$set'] = {'name': name}
+
+    def commit(self):
+        if not self._updates:
+            return
+        database.stats.bulk_write(
+            [UpdateOne({'id': user_id, 'chat': chat}, update, upsert=True)
+             for (chat, user_id), update in self._updates.items()],
+            ordered=False
+        )
+        self._updates = {}
@@ -0,0 +1,30 @@
+"""Stub config for importing the bot package.
+
+The repository root is the package, so pytest imports it before the tests
+inside, and the package reads its settings from a `config` module.
+"""
+
+import os
+import sys
+import types
+import tempfile
+
+
+word_base = tempfile.NamedTemporaryFile(suffix='.txt', delete=False)
+word_base.write('слово\r\n'.encode('cp1251'))
+word_base.close()
+
+config = types.ModuleType('config')
+config.TOKEN = '0:tests'
+config.SKIP_PENDING = False
+config.SET_WEBHOOK = True
+config.LOGGER_LEVEL = 'ERROR'
+config.WORD_BASE = word_base.name
+config.DELETE_FROM_EVERYONE = False
+config.PLAYERS_COUNT_LIMIT = 20
+config.PLAYERS_COUNT_TO_START = 4
+config.REQUEST_OVERDUE_TIME = 600
+config.ADMIN_ID = 0
+sys.modules.setdefault('config', config)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
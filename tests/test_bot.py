@@ -0,0 +1,53 @@
+"""Routing of commands and callback queries to their handlers."""
+
+import os
+import importlib
+
+import pytest
+from telebot.types import Update, User
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+bot = importlib.import_module(os.path.basename(ROOT) + '.bot').bot
+handlers = importlib.import_module(os.path.basename(ROOT) + '.handlers')
+bot.set_identity(User(1, True, 'Mafia Host', username='mafia_host_bot'))
+
+
+def message(**fields):
+    return Update.de_json({'update_id': 1, 'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': -1, 'type': 'supergroup'},
+        'from': {'id': 2, 'is_bot': False, 'first_name': 'Player'},
+        **fields
+    }}).message
+
+
+@pytest.mark.parametrize('fields', [
+    {'sticker': {'file_id': 'a', 'file_unique_id': 'a', 'width': 1, 'height': 1, 'is_animated': False}},
+    {'new_chat_members': [{'id': 3, 'is_bot': False, 'first_name': 'New'}]},
+    {'text': 'hello'},
+    {'text': '/'},
+    {'text': '/ help'},
+    {'text': '/help@other_bot'},
+    {'text': '/unknown'},
+])
+def test_not_a_command(fields):
+    assert bot._find_command(message(**fields)) is None
+
+
+@pytest.mark.parametrize('text', ['/help', '/HELP', '/help@mafia_host_bot', '/help extra words'])
+def test_command(text):
+    routed = message(text=text)
+    handler = bot._find_command(routed)
+    assert handler is not None and handler.__name__ == 'start_command'
+    assert routed.routed_handler is handler
+
+
+def test_callback():
+    call = Update.de_json({'update_id': 1, 'callback_query': {
+        'id': '1', 'chat_instance': '1', 'data': 'vote 3',
+        'from': {'id': 2, 'is_bot': False, 'first_name': 'Player'}
+    }}).callback_query
+    assert bot._find_callback(call) is handlers.vote
+    assert call.routed_handler is handlers.vote
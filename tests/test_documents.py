@@ -0,0 +1,203 @@
+"""documents.py checked against MongoDB.
+
+Every query, update and projection form the handlers use is run on
+documents.py and on mongomock, or on the mongod at MONGO_URI when it is set,
+and the results are compared. mongomock does not evaluate update pipelines,
+so without MONGO_URI those are compared with the expected documents.
+
+    MONGO_URI=mongodb://localhost python -m pytest tests
+"""
+
+import os
+import importlib.util
+from copy import deepcopy
+
+import pytest
+import pymongo
+import mongomock
+from bson import ObjectId
+
+
+spec = importlib.util.spec_from_file_location(
+    'documents', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'documents.py')
+)
+documents = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(documents)
+
+MONGO_URI = os.environ.get('MONGO_URI')
+GAME_ID = ObjectId()
+
+
+def make_game():
+    return {
+        '_id': GAME_ID,
+        'game': 'mafia',
+        'chat': -5,
+        'stage': -4,
+        'day_count': 1,
+        'time': 100,
+        'next_stage_time': 100.5,
+        'message_id': 7,
+        'cards': ['don', 'peace', 'sheriff', 'mafia'],
+        'played': [5],
+        'shots': [],
+        'vote': {'0': [1], '-1': [3]},
+        'names': ['a', 'b'],
+        'players': [
+            {'id': 1, 'name': 'p1', 'full_name': 'P 1', 'alive': True, 'role': 'don'},
+            {'id': 2, 'name': 'p2', 'full_name': 'P 2', 'alive': True, 'role': None},
+            {'id': 3, 'name': 'p3', 'full_name': 'P 3', 'alive': True, 'role': 'sheriff'},
+            {'id': 4, 'name': 'p4', 'full_name': 'P 4', 'alive': False, 'role': 'mafia'},
+        ]
+    }
+
+
+@pytest.fixture
+def collection():
+    if MONGO_URI:
+        client = pymongo.MongoClient(MONGO_URI)
+        games = client.documents_test.games
+    else:
+        games = mongomock.MongoClient().documents_test.games
+    games.drop()
+    games.insert_one(make_game())
+    yield games
+    games.drop()
+
+
+QUERIES = [
+    {'chat': -5},
+    {'chat': 1},
+    {'game': 'mafia', 'stage': -4, 'chat': -5},
+    {'stage': {'$in': [0, -4]}},
+    {'players.id': 2},
+    {'players.id': 9},
+    {'players.0.id': 1},
+    {'players': {'$elemMatch': {'id': 2, 'role': None}}},
+    {'players': {'$elemMatch': {'id': 1, 'role': None}}},
+    {'players': {'$elemMatch': {'id': 1, 'role': {'$in': ['don', 'mafia']}}}},
+    {'players': {'$elemMatch': {'id': 3, 'role': {'$in': ['don', 'mafia']}}}},
+    {'players': {'$elemMatch': {'alive': True, 'role': 'sheriff', 'id': 3}}},
+    {'players': {'$elemMatch': {'alive': True, 'id': 4}}},
+    {'played': {'$ne': 4}},
+    {'played': {'$ne': 5}},
+    {'_id': {'$in': [GAME_ID, ObjectId()]}},
+    {'_id': {'$in': []}},
+    {'time': {'$lte': 100}},
+    {'time': {'$lt': 100}},
+    {'next_stage_time': {'$exists': True}},
+    {'victim': {'$exists': False}},
+    {'victim': None},
+    {'message_id': None},
+    {'vote.0': {'$exists': True}},
+    {'$or': [{'owner': 1}, {'chat': -5}]},
+    {'$or': [{'owner': 1}, {'chat': 5}]},
+]
+
+UPDATES = [
+    {'$set': {'players.1.alive': False, 'victim': 2}},
+    {'$set': {'vote': {}}, '$unset': {'victim': True}},
+    {'$unset': {'message_id': True}},
+    {'$set': {'next_stage_time': 12.5, 'stage': 0, 'played': []}, '$inc': {'day_count': 1}},
+    {'$inc': {'day_count': 1, 'missing': 2}},
+    {'$addToSet': {'played': 5}},
+    {'$addToSet': {'played': 6}},
+    {'$addToSet': {'order': '3'}},
+    {'$push': {'shots': 2}},
+    {'$push': {'new': {'id': 1}}},
+    {'$pull': {'played': 5}},
+    {'$set': {'names.1': 'c', 'players.3.role': 'peace'}},
+]
+
+PROJECTIONS = [
+    None,
+    {'next_stage_time': True},
+    {'_id': False, 'chat': True},
+    {'vote': True, 'order': True},
+    {'game': True, 'players.id': True, 'players.alive': True},
+    {'players.name': True, 'players.role': True},
+    {field: True for field in (
+        'game', 'chat', 'stage', 'victim', 'message_id', 'players.id', 'players.alive',
+        'word', 'player', 'full_name', 'names', 'right', 'wrong'
+    )},
+    {'chat': True, 'players': {'$slice': [2, 1]}},
+    {'chat': True, 'players': {'$slice': [0, 1]}},
+    {'chat': True, 'players': {'$slice': [5, 1]}},
+    {'players': {'$elemMatch': {'id': 3}}, 'stage': True},
+    {'players': {'$elemMatch': {'id': 9}}, 'stage': True},
+    {'players': {'$elemMatch': {'id': 2, 'role': None}}, 'game': True},
+]
+
+
+def take_card(user_id):
+    return [{'$set': {'players': {'$map': {
+        'input': '$players',
+        'as': 'player',
+        'in': {'$cond': [
+            {'$eq': ['$$player.id', user_id]},
+            {'$mergeObjects': ['$$player', {'role': {'$arrayElemAt': [
+                '$cards', {'$indexOfArray': ['$players.id', user_id]}
+            ]}}]},
+            '$$player'
+        ]}
+    }}}}]
+
+
+def vote(user_id, vote_player):
+    return [{'$set': {
+        'played': {'$concatArrays': ['$played', [user_id]]},
+        'vote.%d' % vote_player: {'$concatArrays': [
+            {'$ifNull': ['$vote.%d' % vote_player, []]},
+            [{'$indexOfArray': ['$players.id', user_id]}]
+        ]}
+    }}]
+
+
+def expected(change):
+    game = make_game()
+    change(game)
+    return game
+
+
+PIPELINES = [
+    (take_card(2), expected(lambda game: game['players'][1].update(role='peace'))),
+    (take_card(9), make_game()),
+    (vote(3, 1), expected(lambda game: (game['played'].append(3), game['vote'].update({'1': [2]})))),
+    (vote(1, 0), expected(lambda game: (game['played'].append(1), game['vote']['0'].append(0)))),
+    (vote(2, -1), expected(lambda game: (game['played'].append(2), game['vote']['-1'].append(1)))),
+]
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_query(collection, query):
+    assert documents.matches(make_game(), query) == (collection.find_one(query) is not None)
+
+
+@pytest.mark.parametrize('update', UPDATES)
+def test_update(collection, update):
+    game = make_game()
+    documents.apply_update(game, deepcopy(update))
+    collection.update_one({'_id': GAME_ID}, update)
+    assert game == collection.find_one({'_id': GAME_ID})
+
+
+@pytest.mark.parametrize('projection', PROJECTIONS)
+def test_projection(collection, projection):
+    assert documents.project(make_game(), projection) == collection.find_one({'_id': GAME_ID}, projection)
+
+
+def test_projection_copies():
+    game = make_game()
+    projected = documents.project(game, {'players': {'$slice': [0, 1]}})
+    projected['players'][0]['alive'] = False
+    assert game['players'][0]['alive']
+
+
+@pytest.mark.parametrize('pipeline, result', PIPELINES)
+def test_pipeline(collection, pipeline, result):
+    game = make_game()
+    documents.apply_update(game, pipeline)
+    if MONGO_URI:
+        collection.update_one({'_id': GAME_ID}, pipeline)
+        result = collection.find_one({'_id': GAME_ID})
+    assert game == result
@@ -0,0 +1,42 @@
+"""GameEngine lookups, without the journal reaching the database."""
+
+import os
+import importlib
+
+import pytest
+from bson import ObjectId
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+engine = importlib.import_module(os.path.basename(ROOT) + '.engine')
+
+
+@pytest.fixture
+def games():
+    games = engine.GameEngine(flush_interval=1, snapshot_interval=60)
+    games.insert_one({'_id': 1, 'game': 'mafia', 'chat': -1, 'stage': 0})
+    games.insert_one({'_id': 2, 'game': 'croco', 'chat': -2, 'time': 5})
+    games.insert_one({'game': 'gallows', 'chat': -3})
+    return games
+
+
+@pytest.mark.parametrize('filter, ids', [
+    ({'_id': 1}, [1]),
+    ({'_id': 9}, []),
+    ({'_id': {'$in': [2, 9]}}, [2]),
+    ({'_id': {'$ne': 1}, 'game': 'croco'}, [2]),
+    ({'_id': {'$nin': [1, 2]}, 'chat': -3}, ['other']),
+    ({'_id': {'$exists': True}, 'chat': -1}, [1]),
+    ({'_id': {'$in': [1]}, 'stage': 0}, [1]),
+])
+def test_id_filters(games, filter, ids):
+    found = [game['_id'] if isinstance(game['_id'], int) else 'other' for game in games.find(filter)]
+    assert found == ids
+
+
+def test_writes(games):
+    assert games.update_one({'_id': {'$ne': 2}, 'game': 'mafia'}, {'$inc': {'stage': 1}}).modified_count == 1
+    assert games.find_one({'chat': -1}, {'stage': True}) == {'_id': 1, 'stage': 1}
+    assert games.delete_many({'_id': {'$nin': [1]}}).deleted_count == 2
+    assert [game['_id'] for game in games.find()] == [1]
+    assert isinstance(games.insert_one({'chat': -4}).inserted_id, ObjectId)
@@ -0,0 +1,36 @@
+"""Recording of webhook updates and reading the recordings back."""
+
+import os
+import importlib
+
+recorder = importlib.import_module(
+    os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + '.recorder'
+)
+
+
+def recordings(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory))
+
+
+def test_round_trip(tmp_path):
+    updates = ['{"update_id": 1, "message": {"text": "привет"}}', '{\n  "update_id": 2\n}']
+    writer = recorder.UpdateRecorder(str(tmp_path), max_bytes=1 << 20, backups=2)
+    for i, update in enumerate(updates):
+        writer.record(update, 100.5 + i)
+    writer.close()
+    [path] = recordings(str(tmp_path))
+    assert list(recorder.read_recording(path)) == [
+        (100.5, {'update_id': 1, 'message': {'text': 'привет'}}),
+        (101.5, {'update_id': 2})
+    ]
+
+
+def test_no_backups_keeps_current_file(tmp_path):
+    old = tmp_path / 'updates-20000101-000000-000.jsonl.gz'
+    old.write_bytes(b'')
+    writer = recorder.UpdateRecorder(str(tmp_path), max_bytes=1 << 20, backups=0)
+    writer.record('{"update_id": 1}', 1)
+    writer.close()
+    [path] = recordings(str(tmp_path))
+    assert path != str(old)
+    assert list(recorder.read_recording(path)) == [(1, {'update_id': 1})]
@@ -0,0 +1,56 @@
+"""Order and concurrency of KeyedWorkers."""
+
+import os
+import importlib
+from threading import Event, Lock
+
+KeyedWorkers = importlib.import_module(
+    os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) + '.workers'
+).KeyedWorkers
+
+
+def test_order_within_key():
+    handled, lock, done = [], Lock(), Event()
+
+    def handle(item):
+        with lock:
+            handled.append(item)
+            if len(handled) == 300:
+                done.set()
+
+    workers = KeyedWorkers('Test Worker', handle, key=lambda item: item[0], count=4, queue_size=300)
+    workers.start()
+    for i in range(100):
+        for key in 'abc':
+            assert workers.put((key, i))
+    assert done.wait(5)
+    for key in 'abc':
+        assert [i for k, i in handled if k == key] == list(range(100))
+
+
+def test_blocked_key_holds_one_thread():
+    release, handled = Event(), Event()
+
+    def handle(item):
+        if item == 'blocked':
+            release.wait(5)
+        else:
+            handled.set()
+
+    # Both keys land on the same thread when keys are pinned by hash
+    workers = KeyedWorkers('Test Worker', handle, key=lambda item: 0 if item == 'blocked' else 2, count=2, queue_size=10)
+    workers.start()
+    workers.put('blocked')
+    workers.put('other')
+    try:
+        assert handled.wait(5)
+    finally:
+        release.set()
+
+
+def test_queue_size():
+    release = Event()
+    workers = KeyedWorkers('Test Worker', lambda item: release.wait(5), key=lambda item: item, count=1, queue_size=2)
+    assert workers.put(1) and workers.put(2)
+    assert not workers.put(3)
+    release.set()
@@ -0,0 +1,77 @@
+from .logger import logger
+from .profiler import profiler
+from .lease import leader_lease
+
+from math import ceil
+from time import time, sleep
+from threading import Lock
+
+
+class TimingWheel:
+    """Hashed timing wheel firing batches of expired keys once per tick.
+
+    Every timer kind has a single handler which receives the list of keys
+    that expired during a tick, so that it can serve them with bulk queries.
+    Handlers must check that a key is still due: rescheduling only adds a new
+    entry and never removes the old one. Timers are only kept while
+    `active()` is true: other instances load them from the database when
+    they take over.
+    """
+
+    def __init__(self, tick=1, size=512, active=lambda: True):
+        self.tick = tick
+        self.active = active
+        self.size = size
+        self._slots = [[] for _ in range(size)]
+        self._handlers = {}
+        self._lock = Lock()
+        self._current = int(time() // tick)
+
+    def on(self, kind):
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    def add(self, kind, key, deadline):
+        if not self.active():
+            return
+        with self._lock:
+            expiry = max(ceil(deadline / self.tick), self._current + 1)
+            self._slots[expiry % self.size].append((expiry, kind, key))
+
+    def clear(self):
+        with self._lock:
+            self._slots = [[] for _ in range(self.size)]
+
+    def _expire(self, now_tick):
+        due = {}
+        with self._lock:
+            for tick in range(self._current + 1, min(now_tick, self._current + self.size) + 1):
+                slot = self._slots[tick % self.size]
+                pending = []
+                for entry in slot:
+                    expiry, kind, key = entry
+                    if expiry <= now_tick:
+                        due.setdefault(kind, {})[key] = None
+                    else:
+                        pending.append(entry)
+                self._slots[tick % self.size] = pending
+            self._current = now_tick
+        return due
+
+    def run(self, active=None):
+        """Fire expired timers once per tick for as long as `active()` is true."""
+        active = active or self.active
+        while active():
+            sleep(max(0, (self._current + 1) * self.tick - time()))
+            due = self._expire(int(time() // self.tick))
+            with profiler.capture():
+                for kind, keys in due.items():
+                    try:
+                        self._handlers[kind](list(keys))
+                    except Exception:
+                        logger.exception('Ошибка при обработке таймеров <%s>', kind)
+
+
+timers = TimingWheel(active=lambda: leader_lease.is_leader)
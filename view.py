@@ -0,0 +1,104 @@
+from .engine import games
+
+from copy import deepcopy
+
+
+class FieldNotFetched(KeyError):
+    pass
+
+
+def _field_tree(fields):
+    tree = {}
+    for field in fields:
+        node = tree
+        *parents, name = field.split('.')
+        for parent in parents:
+            node = node.setdefault(parent, {})
+            if node is None:
+                break
+        else:
+            node[name] = None
+    return tree
+
+
+def _wrap(value, tree):
+    if isinstance(value, list):
+        return [_wrap(item, tree) for item in value]
+    if isinstance(value, dict):
+        return GameView(value, tree)
+    return value
+
+
+class GameView(dict):
+    """Game document read with a projection.
+
+    Reading a field that the projection left out raises FieldNotFetched
+    instead of looking like a field missing from the game, so handlers cannot
+    silently depend on data they did not fetch. Fields given as `matched`
+    hold only the array element selected with `$elemMatch` and are read with
+    `matched()`.
+    """
+
+    def __init__(self, document, fields, matched=()):
+        tree = fields if isinstance(fields, dict) else _field_tree(fields)
+        super().__init__(
+            (key, _wrap(value, tree[key]) if tree.get(key) else value)
+            for key, value in document.items()
+        )
+        self._fields = tree
+        self._matched = frozenset(matched)
+
+    def _check(self, key):
+        if key not in self._fields and key != '_id':
+            if key in self._matched:
+                raise FieldNotFetched(f'only the element of {key!r} matched by $elemMatch was fetched')
+            raise FieldNotFetched(f'{key!r} was not fetched')
+
+    def __getitem__(self, key):
+        self._check(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self._check(key)
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        self._check(key)
+        return super().get(key, default)
+
+    def matched(self, key):
+        if key not in self._matched:
+            raise FieldNotFetched(f'{key!r} was not fetched with $elemMatch')
+        elements = super().get(key)
+        return elements[0] if elements else None
+
+    def __deepcopy__(self, memo):
+        view = GameView.__new__(GameView)
+        dict.__init__(view, ((key, deepcopy(value, memo)) for key, value in dict.items(self)))
+        view._fields = self._fields
+        view._matched = self._matched
+        return view
+
+
+def game_projection(fields, matched=None):
+    projection = {field: True for field in fields}
+    for field, condition in (matched or {}).items():
+        projection[field] = {'$elemMatch': condition}
+    return projection
+
+
+def view(document, fields, matched=()):
+    return None if document is None else GameView(document, fields, matched)
+
+
+def find_game(filter, fields, matched=None):
+    """Read a game with only `fields` and the elements selected by `matched` ({field: $elemMatch condition})."""
+    return view(games.find_one(filter, game_projection(fields, matched)), fields, matched or ())
+
+
+# Fields every group message handler may use: what `_game_handler` needs to
+# decide on deleting a message, and the state of croco and gallows games
+GAME_HEADER = (
+    'game', 'chat', 'stage', 'victim', 'message_id', 'players.id', 'players.alive',
+    'word', 'player', 'full_name', 'names', 'right', 'wrong'
+)
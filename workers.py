@@ -0,0 +1,96 @@
+import config
+from .logger import logger
+from .bot import bot
+
+from queue import Queue
+from threading import Lock, Thread
+from collections import deque
+
+
+def get_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+
+class KeyedWorkers:
+    """Threads handling items in parallel while keeping the order of the items with the same key.
+
+    Items wait in a queue per key, and a free thread takes the next key that
+    has items and is not being handled, so a key is handled by one thread at
+    a time and a key that blocks (a chat waiting for its flood limit) holds
+    only its own thread. Up to `count` such keys can wait at once before the
+    other keys are delayed, so `count` should exceed the number of chats
+    expected to be throttled together. At most `queue_size` items wait.
+    `handle` must not raise.
+    """
+
+    def __init__(self, name, handle, key, count, queue_size):
+        self.name = name
+        self.handle = handle
+        self.key = key
+        self.count = count
+        self.queue_size = queue_size
+        self._items = {}
+        self._size = 0
+        self._ready = Queue()
+        self._lock = Lock()
+
+    def start(self):
+        for i in range(self.count):
+            Thread(name=f'{self.name} {i}', target=self._work, daemon=True).start()
+
+    def put(self, item):
+        key = self.key(item)
+        with self._lock:
+            if self._size >= self.queue_size:
+                return False
+            self._size += 1
+            items = self._items.get(key)
+            if items is None:
+                self._items[key] = deque([item])
+                self._ready.put(key)
+            else:
+                items.append(item)
+        return True
+
+    def _work(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                item = self._items[key].popleft()
+                self._size -= 1
+            self.handle(item)
+            with self._lock:
+                # The key stays in `_items` while it is handled, so `put` does not make it ready twice
+                if self._items[key]:
+                    self._ready.put(key)
+                else:
+                    del self._items[key]
+
+
+class UpdateWorkers(KeyedWorkers):
+    """Threads processing updates in parallel while keeping the order within each chat."""
+
+    def __init__(self, process, count, queue_size):
+        super().__init__('Update Worker', self._process, get_chat_id, count, queue_size)
+        self.process = process
+
+    def _process(self, update):
+        try:
+            self.process([update])
+        except Exception:
+            logger.exception('Ошибка при обработке обновления %s', update.update_id)
+
+
+workers = UpdateWorkers(
+    bot.process_new_updates,
+    count=getattr(config, 'WORKERS_COUNT', 16),
+    queue_size=getattr(config, 'UPDATE_QUEUE_SIZE', 1000)
+)